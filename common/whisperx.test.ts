@@ -0,0 +1,51 @@
+import { decodeCompactWhisperX } from 'common/whisperx';
+
+import type { CompactWhisperXTranscript } from 'common/whisperx';
+
+it('decodeCompactWhisperX() expands columns back into WhisperX json', () => {
+  const compact : CompactWhisperXTranscript = {
+    format: 'whisperx-columnar',
+    version: 1,
+    language: 'en',
+    speakers: ['SPEAKER_01', 'SPEAKER_00'],
+    segment_starts: [369, 9000],
+    segment_ends: [1630, 9500],
+    segment_speakers: [0, 1],
+    segment_word_counts: [2, 1],
+    segment_text_prefixes: [' ', ''],
+    segment_texts: {'1': '2024.'},
+    words: ['of', 'audit', '2024.'],
+    word_starts: [369, 469, null],
+    word_ends: [449, 829, null],
+    word_scores: [920, 809, null],
+    word_speakers: [0, 1, null],
+  };
+
+  expect(decodeCompactWhisperX(compact)).toStrictEqual({
+    language: 'en',
+    segments: [
+      {
+        start: 0.369,
+        end: 1.63,
+        text: ' of audit',
+        speaker: 'SPEAKER_01',
+        words: [
+          {word: 'of', start: 0.369, end: 0.449, score: 0.92, speaker: 'SPEAKER_01'},
+          {word: 'audit', start: 0.469, end: 0.829, score: 0.809, speaker: 'SPEAKER_00'},
+        ],
+      },
+      {
+        start: 9,
+        end: 9.5,
+        text: '2024.',
+        speaker: 'SPEAKER_00',
+        words: [{word: '2024.'}],
+      },
+    ],
+  });
+});
+
+it('decodeCompactWhisperX() rejects unknown encodings', () => {
+  expect(() => decodeCompactWhisperX(
+      {format: 'whisperx-columnar', version: 2} as unknown as CompactWhisperXTranscript)).toThrow();
+});
@@ -41,6 +41,81 @@ export type WhisperXWordData = {
   speaker: string;
 };
 
+// Columnar form of a WhisperXTranscript produced by the transcription worker
+// (tools/process_new_vids/transcript_codec.py). Times are integer
+// milliseconds, scores are integer per-mille and speakers index into
+// `speakers`. null marks a value missing from the original. Segment text is
+// only present in `segment_texts` when it is not the segment's words joined
+// by spaces after `segment_text_prefixes`.
+export type CompactWhisperXTranscript = {
+  format: 'whisperx-columnar';
+  version: 1;
+  language: string;
+  speakers: string[];
+  segment_starts: (number | null)[];
+  segment_ends: (number | null)[];
+  segment_speakers: (number | null)[];
+  segment_word_counts: number[];
+  segment_text_prefixes: string[];
+  segment_texts: {[segmentIndex: string]: string};
+  words: string[];
+  word_starts: (number | null)[];
+  word_ends: (number | null)[];
+  word_scores: (number | null)[];
+  word_speakers: (number | null)[];
+};
+
+// Expands a CompactWhisperXTranscript back into the WhisperX json shape.
+export function decodeCompactWhisperX(compact: CompactWhisperXTranscript) : WhisperXTranscript {
+  if (compact.format !== 'whisperx-columnar' || compact.version !== 1) {
+    throw new Error(`Unsupported transcript encoding ${compact.format} v${compact.version}`);
+  }
+
+  // Value at `index` of a column scaled by `divisor`, or undefined if missing.
+  const scaled = (column: (number | null)[], index: number, divisor: number) => {
+    const value = column[index];
+    return value === null ? undefined : value / divisor;
+  };
+  const speaker = (column: (number | null)[], index: number) => {
+    const speakerIndex = column[index];
+    return speakerIndex === null ? undefined : compact.speakers[speakerIndex];
+  };
+  // Only set keys that have a value so the result matches the original json.
+  const definedOnly = <T extends object>(obj: T) : T => {
+    return Object.fromEntries(
+      Object.entries(obj).filter(([_, value]) => value !== undefined)) as T;
+  };
+
+  const segments = new Array<WhisperXSegmentData>;
+  let w = 0;
+  for (const [i, numWords] of compact.segment_word_counts.entries()) {
+    const words = new Array<WhisperXWordData>;
+    for (let j = w; j < w + numWords; j++) {
+      words.push(definedOnly({
+        word: compact.words[j],
+        start: scaled(compact.word_starts, j, 1000),
+        end: scaled(compact.word_ends, j, 1000),
+        score: scaled(compact.word_scores, j, 1000),
+        speaker: speaker(compact.word_speakers, j),
+      } as WhisperXWordData));
+    }
+
+    const text = (String(i) in compact.segment_texts) ?
+      compact.segment_texts[String(i)] :
+      compact.segment_text_prefixes[i] + compact.words.slice(w, w + numWords).join(' ');
+    segments.push(definedOnly({
+      start: scaled(compact.segment_starts, i, 1000),
+      end: scaled(compact.segment_ends, i, 1000),
+      text,
+      words,
+      speaker: speaker(compact.segment_speakers, i),
+    } as WhisperXSegmentData));
+    w += numWords;
+  }
+
+  return { segments, language: compact.language };
+}
+
 // Create path to the compressed WhipserX file for the given parameters.
 export function makeWhisperXTranscriptsPath(
     category: CategoryId,
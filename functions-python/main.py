@@ -1,5 +1,7 @@
 import datetime
 import json
+import math
+import re
 import secrets
 
 from firebase_admin import initialize_app, db
@@ -15,6 +17,15 @@ MINS_PER_VID = 10
 VIDS_PER_MACHINE = 20
 INSTANCE_STALE_S = 60 * 60 * 2  # 2hrs is a long time for these jobs.
 
+# Per machine profile processing times reported by the workers. See
+# tools/process_new_vids/runtime_table.py.
+RUNTIME_TABLE_PATH = "/transcripts/private/_admin/runtime_table"
+# Videos needed before learned runtimes replace MINS_PER_VID.
+MIN_RUNTIME_VIDEOS = 3
+# Learned times are averages. Workers exit as soon as they are out of work
+# so a generous lysine timeout costs nothing.
+RUNTIME_SAFETY = 1.5
+
 
 def _access_secret_version(project_id, secret_id, version_id="latest"):
     client = secretmanager.SecretManagerServiceClient()
@@ -31,6 +42,42 @@ def _access_secret_version(project_id, secret_id, version_id="latest"):
     return payload
 
 
+def _normalize_gpu(name):
+    # Same as normalize_gpu() in tools/process_new_vids/runtime_table.py,
+    # which maps torch's "NVIDIA GeForce RTX 3090" to vast.ai's "RTX 3090".
+    name = re.sub(r"\b(NVIDIA|GeForce)\b", "", name or "")
+    return re.sub(r"[.$#\[\]/|]+", "_",
+                  " ".join(name.split())).replace(" ", "_")
+
+
+def _mins_per_vid(runtime_table, offer=None):
+    """Expected minutes to transcribe a typical queued video.
+
+    Uses the rows for the offer's GPUs if there are enough, else every row,
+    else MINS_PER_VID. Each row holds sums over the videos a machine profile
+    processed, so the mean processing time is y / n. Workers record the
+    time a video adds to a machine rather than its own start to finish time,
+    so the mean times the number of videos is the machine time needed.
+    """
+    runtime_table = runtime_table or {}
+    rows = list(runtime_table.values())
+    if offer:
+        gpu = _normalize_gpu(offer.get('gpu_name'))
+        if offer.get('num_gpus', 1) > 1:
+            gpu = f"{offer['num_gpus']}x{gpu}"
+        candidates = [[row for key, row in runtime_table.items()
+                       if key.split("|")[0] == gpu], rows]
+    else:
+        candidates = [rows]
+
+    for candidate in candidates:
+        n = sum(row.get('n', 0) for row in candidate)
+        if n >= MIN_RUNTIME_VIDEOS:
+            mean_s = sum(row.get('y', 0) for row in candidate) / n
+            return mean_s / 60 * RUNTIME_SAFETY
+    return MINS_PER_VID
+
+
 @pubsub_fn.on_message_published(topic="start_transcribe", region="us-west1")
 def start_transcribe(
         event: pubsub_fn.CloudEvent[pubsub_fn.MessagePublishedData]) -> None:
@@ -50,14 +97,18 @@ def start_transcribe(
     # If there are any entries, ensure a vast.ai instance is running.
     if num_new_videos > 0:
         # TODO: heartbeat terminate stale instances.
-        lysine_timeout = num_new_videos * MINS_PER_VID
+        runtime_table = db.reference(RUNTIME_TABLE_PATH).get()
 
         # Search for all offers.
         vast = VastAI(
             _access_secret_version('sps-by-the-numbers', 'vast_api_key'),
             raw=True)
 
-        target_num_instances = max(1, int(num_new_videos / VIDS_PER_MACHINE))
+        # Each machine gets about VIDS_PER_MACHINE * MINS_PER_VID minutes of
+        # work, measured in learned minutes once there are any.
+        target_num_instances = max(1, int(
+            num_new_videos * _mins_per_vid(runtime_table) /
+            (VIDS_PER_MACHINE * MINS_PER_VID)))
 
         # Do not create new instance if one is running.
         all_instances = json.loads(vast.show_instances())
@@ -84,6 +135,11 @@ def start_transcribe(
             print(f"cheapest ask id {cheapest['ask_contract_id']} cost "
                   f"{json.dumps(cheapest)}")
 
+            # The worker stops taking videos it cannot finish in time so
+            # this only needs to cover what it takes on.
+            lysine_timeout = math.ceil(
+                num_new_videos * _mins_per_vid(runtime_table, cheapest))
+
             # Create a password for the instance to use with our REST API.
             instance_password = secrets.token_urlsafe(16)
             start_time = datetime.datetime.now(
@@ -7,6 +7,8 @@ const AUTH_CODE_ENDPOINTS = [
   [ 'DELETE', 'video_queue' ],
   [ 'GET', 'video_queue' ],
 
+  [ 'GET', 'vast' ],
+  [ 'PATCH', 'vast' ],
   [ 'DELETE', 'vast' ],
 
   [ 'PUT', 'transcript' ],
@@ -1,4 +1,27 @@
 import * as TestingUtils from './utils/testing';
+import { DiarizedTranscript } from 'common/transcript';
+import { decodeCompactWhisperX } from 'common/whisperx';
+import { getStorageAccessor } from './utils/storage';
+
+import type { CompactWhisperXTranscript } from 'common/whisperx';
+
+const COMPACT_TRANSCRIPT : CompactWhisperXTranscript = {
+  format: 'whisperx-columnar',
+  version: 1,
+  language: 'en',
+  speakers: ['SPEAKER_01', 'SPEAKER_00'],
+  segment_starts: [369, 9000],
+  segment_ends: [1630, 9500],
+  segment_speakers: [0, 1],
+  segment_word_counts: [2, 1],
+  segment_text_prefixes: [' ', ''],
+  segment_texts: {'1': '2024.'},
+  words: ['of', 'audit', '2024.'],
+  word_starts: [369, 469, 9000],
+  word_ends: [449, 829, 9500],
+  word_scores: [920, 809, 750],
+  word_speakers: [0, 1, 1],
+};
 
 describe('transcript', () => {
   beforeAll(TestingUtils.beforeAll);
@@ -29,4 +52,43 @@ describe('transcript', () => {
     const responseJson = await response.json();
     expect(responseJson.ok).toStrictEqual(true);
   });
+  it('PUT sets transcript from compact_transcripts', async () => {
+    const category = 'sps-board';
+    const video_id = 'compactTst1';
+    const response = await TestingUtils.fetchEndpoint(
+        'transcript',
+        'PUT',
+        { user_id: TestingUtils.FAKE_USER_ID,
+          auth_code: TestingUtils.FAKE_AUTH_CODE,
+          category,
+          video_id,
+          compact_transcripts: {en: COMPACT_TRANSCRIPT},
+          metadata: {...TestingUtils.DATA_METADATA, video_id},
+        });
+    expect(response.status).toStrictEqual(200);
+    const responseJson = await response.json();
+    expect(responseJson.ok).toStrictEqual(true);
+
+    const expected = DiarizedTranscript.fromWhisperX(
+        category, video_id, decodeCompactWhisperX(COMPACT_TRANSCRIPT));
+    const stored = await DiarizedTranscript.fromStorage(
+        getStorageAccessor(), category, video_id, ['eng']);
+    expect(stored.loadErrors).toEqual([]);
+    expect(stored.sentenceInfo).toEqual(expected.sentenceInfo);
+    expect(stored.languageToSentenceTable).toEqual(expected.languageToSentenceTable);
+  });
+  it('PUT needs transcripts or compact_transcripts', async () => {
+    const response = await TestingUtils.fetchEndpoint(
+        'transcript',
+        'PUT',
+        { user_id: TestingUtils.FAKE_USER_ID,
+          auth_code: TestingUtils.FAKE_AUTH_CODE,
+          category: 'sps-board',
+          video_id: 'MT2zjpRbQJA',
+          metadata: TestingUtils.DATA_METADATA,
+        });
+    expect(response.status).toStrictEqual(400);
+    const responseJson = await response.json();
+    expect(responseJson.ok).toStrictEqual(false);
+  });
 });
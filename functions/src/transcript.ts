@@ -1,13 +1,14 @@
 import * as Constants from 'config/constants';
 import langs from 'langs';
 import { DiarizedTranscript } from 'common/transcript';
+import { decodeCompactWhisperX } from 'common/whisperx';
 import { getAuthCode, jsonOnRequest } from './utils/firebase';
 import { setMetadata } from './utils/metadata';
 import { getStorageAccessor } from './utils/storage';
 import { makeResponseJson } from './utils/response';
 import { validateObj } from './utils/validation';
 
-import type { WhisperXTranscript } from 'common/whisperx';
+import type { CompactWhisperXTranscript, WhisperXTranscript } from 'common/whisperx';
 import type { Iso6393Code, VideoId } from 'common/params';
 
 const LANGUAGES = new Set<Iso6393Code>(["eng"]);
@@ -35,7 +36,13 @@ async function uploadTrancript(req, res) {
     return res.status(400).send(makeResponseJson(false, requestErrors.join(', ')));
   }
 
-  const transcripts = req.body.transcripts || {};
+  // The worker may send the compact columnar encoding instead of raw
+  // WhisperX json to cut upload size.
+  const transcripts = {...(req.body.transcripts || {})};
+  for (const [iso6391Lang, compact] of Object.entries(req.body.compact_transcripts || {})) {
+    transcripts[iso6391Lang] = decodeCompactWhisperX(compact as CompactWhisperXTranscript);
+  }
+
   for (const iso6391Lang of Object.keys(transcripts)) {
     const lang : Iso6393Code = langs.where('1', iso6391Lang)['3'];
     if (!LANGUAGES.has(lang)) {
@@ -50,8 +57,12 @@ async function uploadTrancript(req, res) {
     console.log("Saved video: ", req.body.video_id, " language: ", lang);
     const diarizedTranscript = await DiarizedTranscript.fromWhisperX(
         req.body.category, req.body.video_id, whisperXTranscript);
-    diarizedTranscript.writeSentenceTable(getStorageAccessor(), lang);
-    diarizedTranscript.writeDiarizedTranscript(getStorageAccessor());
+    // Finish writing before responding. The function may be stopped once
+    // the response is sent.
+    await Promise.all([
+      diarizedTranscript.writeSentenceTable(getStorageAccessor(), lang),
+      diarizedTranscript.writeDiarizedTranscript(getStorageAccessor()),
+    ]);
   }
 
   if (req.body.metadata && ! (await setMetadata(req.body.category, req.body.metadata))) {
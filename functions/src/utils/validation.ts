@@ -32,6 +32,31 @@ export const Schemas = {
     },
   },
 
+  compactWhisperXTranscript: {
+    type: "object",
+    required: ["format", "version", "language", "speakers",
+               "segment_starts", "segment_ends", "segment_speakers",
+               "segment_word_counts", "segment_text_prefixes", "segment_texts",
+               "words", "word_starts", "word_ends", "word_scores", "word_speakers"],
+    properties: {
+      format: { const: "whisperx-columnar" },
+      version: { const: 1 },
+      language: { "$ref": "iso639-1" },
+      speakers: { type: "array", items: { type: "string" } },
+      segment_starts: { type: "array", items: { type: ["integer", "null"] } },
+      segment_ends: { type: "array", items: { type: ["integer", "null"] } },
+      segment_speakers: { type: "array", items: { type: ["integer", "null"] } },
+      segment_word_counts: { type: "array", items: { type: "integer" } },
+      segment_text_prefixes: { type: "array", items: { type: "string" } },
+      segment_texts: { type: "object", additionalProperties: { type: "string" } },
+      words: { type: "array", items: { type: "string" } },
+      word_starts: { type: "array", items: { type: ["integer", "null"] } },
+      word_ends: { type: "array", items: { type: ["integer", "null"] } },
+      word_scores: { type: "array", items: { type: ["integer", "null"] } },
+      word_speakers: { type: "array", items: { type: ["integer", "null"] } },
+    },
+  },
+
   whisperXSegmentData: {
     type: "object",
     properties: {
@@ -86,7 +111,11 @@ export const Schemas = {
   // Validations for individual request objects.
   uploadTranscriptRequest : {
     type: "object",
-    required: ["category", "video_id", "transcripts"],
+    required: ["category", "video_id"],
+    anyOf: [
+      { required: ["transcripts"] },
+      { required: ["compact_transcripts"] },
+    ],
 
     properties: {
       category: { "$ref": "category" },
@@ -98,6 +127,13 @@ export const Schemas = {
           [Iso639_1Regex]: { "$ref": "whisperXTranscript" }
         },
       },
+      compact_transcripts: {
+        type: "object",
+        minProperties: 1,
+        patternProperties: {
+          [Iso639_1Regex]: { "$ref": "compactWhisperXTranscript" }
+        },
+      },
       metadata: { "$ref": "metadata" },
     },
   },
@@ -1,6 +1,13 @@
 import * as Constants from 'config/constants';
 import * as TestingUtils from './utils/testing';
-import { getCategoryPrivateDb } from './utils/firebase';
+import { getCategoryPrivateDb, setAuthCode } from './utils/firebase';
+
+const OTHER_USER_ID = 'otheruser';
+const OTHER_AUTH_CODE = 'other_auth';
+
+function minutesFromNow(minutes : number) {
+  return new Date(Date.now() + minutes * 60 * 1000).toISOString();
+}
 
 describe('video_queue', () => {
   beforeAll(TestingUtils.beforeAll);
@@ -20,4 +27,171 @@ describe('video_queue', () => {
     expect(responseJson.data[category]).toEqual(NEW_VIDS);
   });
 
+  describe('PATCH leases', () => {
+    const category = Constants.ALL_CATEGORIES[0];
+    const queueRef = () => getCategoryPrivateDb(category, 'new_vids');
+
+    beforeAll(async () => {
+      await setAuthCode(OTHER_USER_ID, OTHER_AUTH_CODE);
+    });
+
+    beforeEach(async () => {
+      await queueRef().set({
+        free: {add: minutesFromNow(-60), lease_expires: "", vast_instance: ""},
+        mine: {add: minutesFromNow(-60), lease_expires: minutesFromNow(5),
+               vast_instance: TestingUtils.FAKE_USER_ID},
+        theirs: {add: minutesFromNow(-60), lease_expires: minutesFromNow(5),
+                 vast_instance: OTHER_USER_ID},
+      });
+    });
+
+    function patchQueue(video_ids : string[], release = false) {
+      return TestingUtils.fetchEndpoint(
+          'video_queue',
+          'PATCH',
+          { user_id: TestingUtils.FAKE_USER_ID,
+            auth_code: TestingUtils.FAKE_AUTH_CODE,
+            category,
+            video_ids,
+            release });
+    }
+
+    async function getEntry(vid : string) {
+      return (await queueRef().child(vid).once('value')).val();
+    }
+
+    it('grants the unleased part of a batch', async () => {
+      const response = await patchQueue(['free', 'theirs']);
+      expect(response.status).toStrictEqual(200);
+      const responseJson = await response.json();
+      expect(responseJson.data.updated_ids).toEqual(['free']);
+      expect(responseJson.data.leased_ids).toEqual(['theirs']);
+      expect((await getEntry('free')).vast_instance).toStrictEqual(TestingUtils.FAKE_USER_ID);
+      expect((await getEntry('theirs')).vast_instance).toStrictEqual(OTHER_USER_ID);
+    });
+
+    it('403s only when nothing was granted', async () => {
+      const response = await patchQueue(['theirs']);
+      expect(response.status).toStrictEqual(403);
+      const responseJson = await response.json();
+      expect(responseJson.ok).toStrictEqual(false);
+      expect((await getEntry('theirs')).vast_instance).toStrictEqual(OTHER_USER_ID);
+    });
+
+    it('does not add videos missing from the queue', async () => {
+      const response = await patchQueue(['deleted']);
+      expect(response.status).toStrictEqual(200);
+      const responseJson = await response.json();
+      expect(responseJson.data.updated_ids).toEqual([]);
+      expect(await getEntry('deleted')).toBeNull();
+    });
+
+    it('renews its own lease', async () => {
+      const before = (await getEntry('mine')).lease_expires;
+      const response = await patchQueue(['mine']);
+      expect(response.status).toStrictEqual(200);
+      const responseJson = await response.json();
+      expect(responseJson.data.updated_ids).toEqual(['mine']);
+      const entry = await getEntry('mine');
+      expect(entry.vast_instance).toStrictEqual(TestingUtils.FAKE_USER_ID);
+      expect(entry.lease_expires > before).toStrictEqual(true);
+    });
+
+    it('releases only leases the caller owns', async () => {
+      const response = await patchQueue(['mine', 'theirs'], true);
+      expect(response.status).toStrictEqual(200);
+      const responseJson = await response.json();
+      expect(responseJson.data.updated_ids).toEqual(['mine']);
+      expect(responseJson.data.leased_ids).toEqual(['theirs']);
+      const mine = await getEntry('mine');
+      expect(mine.vast_instance).toStrictEqual("");
+      expect(mine.lease_expires).toStrictEqual("");
+      expect((await getEntry('theirs')).vast_instance).toStrictEqual(OTHER_USER_ID);
+    });
+
+    it('refuses a release by someone else', async () => {
+      const before = await getEntry('theirs');
+      const response = await patchQueue(['theirs'], true);
+      expect(response.status).toStrictEqual(403);
+      expect(await getEntry('theirs')).toEqual(before);
+    });
+  });
+});
+
+describe('vast', () => {
+  beforeAll(TestingUtils.beforeAll);
+
+  const KEY = 'RTX_3090|float16|16';
+  const ROW = {n: 2, x: 30, y: 600, xx: 500, xy: 9000,
+               stage_s: {asr: 300, diarize: 200}};
+  const tableRef = () => getCategoryPrivateDb('_admin', 'runtime_table');
+
+  function patchVast(runtime_table : any) {
+    return TestingUtils.fetchEndpoint(
+        'vast',
+        'PATCH',
+        { user_id: TestingUtils.FAKE_USER_ID,
+          auth_code: TestingUtils.FAKE_AUTH_CODE,
+          runtime_table });
+  }
+
+  beforeEach(async () => {
+    await tableRef().set({[KEY]: ROW});
+  });
+
+  it('GET returns the runtime table', async () => {
+    const response = await TestingUtils.fetchEndpoint(
+        'vast',
+        'GET',
+        { user_id: TestingUtils.FAKE_USER_ID,
+          auth_code: TestingUtils.FAKE_AUTH_CODE });
+    expect(response.status).toStrictEqual(200);
+    const responseJson = await response.json();
+    expect(responseJson.ok).toStrictEqual(true);
+    expect(responseJson.data).toEqual({[KEY]: ROW});
+  });
+
+  it('GET returns an empty table when there is none', async () => {
+    await tableRef().remove();
+    const response = await TestingUtils.fetchEndpoint(
+        'vast',
+        'GET',
+        { user_id: TestingUtils.FAKE_USER_ID,
+          auth_code: TestingUtils.FAKE_AUTH_CODE });
+    expect(response.status).toStrictEqual(200);
+    const responseJson = await response.json();
+    expect(responseJson.data).toEqual({});
+  });
+
+  it('PATCH adds rows to the table', async () => {
+    const NEW_KEY = 'RTX_4090|float16|32';
+    const response = await patchVast({
+      [KEY]: {n: 1, x: 10, y: 100, xx: 100, xy: 1000,
+              stage_s: {asr: 50, align: 10}},
+      [NEW_KEY]: ROW,
+    });
+    expect(response.status).toStrictEqual(200);
+    const table = (await tableRef().once('value')).val();
+    expect(table[KEY]).toEqual({n: 3, x: 40, y: 700, xx: 600, xy: 10000,
+                                stage_s: {asr: 350, diarize: 200, align: 10}});
+    expect(table[NEW_KEY]).toEqual(ROW);
+  });
+
+  const BAD_TABLES : Array<[string, any]> = [
+    ['a table that is not an object', 'rows'],
+    ['a row missing a sum', {[KEY]: {n: 1, x: 10, y: 100, xx: 100}}],
+    ['a sum that is not a number', {[KEY]: {...ROW, y: '100'}}],
+    ['a stage time that is not a number', {[KEY]: {...ROW, stage_s: {asr: null}}}],
+    ['a row that is not an object', {[KEY]: 5}],
+  ];
+
+  for (const [name, runtime_table] of BAD_TABLES) {
+    it(`PATCH rejects ${name}`, async () => {
+      const response = await patchVast(runtime_table);
+      expect(response.status).toStrictEqual(400);
+      const responseJson = await response.json();
+      expect(responseJson.ok).toStrictEqual(false);
+      expect((await tableRef().once('value')).val()).toEqual({[KEY]: ROW});
+    });
+  }
 });
@@ -114,6 +114,66 @@ async function removeVastInstance(req, res) {
   return res.status(200).send(makeResponseJson(true, "Instance removed"));
 }
 
+async function getRuntimeTable(req, res) {
+  const authCodeErrors = validateObj(req.query, 'authCodeParam');
+  if (authCodeErrors.length) {
+    return res.status(401).send(makeResponseJson(false, authCodeErrors.join(', ')));
+  }
+
+  const auth_code = (await getAuthCode(req.query.user_id));
+  if (req.query.auth_code !== auth_code) {
+    return res.status(401).send(makeResponseJson(false, "invalid auth_code"));
+  }
+
+  const table = (await getCategoryPrivateDb("_admin").child("runtime_table").once("value")).val();
+  return res.status(200).send(makeResponseJson(true, "Runtime table", table || {}));
+}
+
+const RUNTIME_SUM_FIELDS = ['n', 'x', 'y', 'xx', 'xy'];
+
+function isRuntimeRow(row) : boolean {
+  return typeof row === 'object' && row !== null &&
+    RUNTIME_SUM_FIELDS.every(field => typeof row[field] === 'number' && isFinite(row[field])) &&
+    Object.values(row.stage_s || {}).every(v => typeof v === 'number' && isFinite(v));
+}
+
+// Adds a worker's per machine profile runtime sums (see
+// tools/process_new_vids/runtime_table.py) into the shared table. Rows are
+// sums so merging is addition, done in a transaction per profile since
+// workers finish concurrently.
+async function addRuntimeRows(req, res) {
+  const authCodeErrors = validateObj(req.body, 'authCodeParam');
+  if (authCodeErrors.length) {
+    return res.status(401).send(makeResponseJson(false, authCodeErrors.join(', ')));
+  }
+
+  const auth_code = (await getAuthCode(req.body.user_id));
+  if (req.body.auth_code !== auth_code) {
+    return res.status(401).send(makeResponseJson(false, "invalid auth_code"));
+  }
+
+  const rows = req.body.runtime_table;
+  if (typeof rows !== 'object' || rows === null ||
+      !Object.values(rows).every(isRuntimeRow)) {
+    return res.status(400).send(makeResponseJson(false, "Expects runtime_table rows"));
+  }
+
+  const table_ref = getCategoryPrivateDb("_admin").child("runtime_table");
+  await Promise.all(Object.entries(rows).map(([key, row] : [string, any]) =>
+    table_ref.child(key).transaction((current) => {
+      const merged = {...(current || {}), stage_s: {...(current?.stage_s || {})}};
+      for (const field of RUNTIME_SUM_FIELDS) {
+        merged[field] = (merged[field] || 0) + row[field];
+      }
+      for (const [stage, seconds] of Object.entries(row.stage_s || {})) {
+        merged.stage_s[stage] = (merged.stage_s[stage] || 0) + (seconds as number);
+      }
+      return merged;
+    })));
+
+  return res.status(200).send(makeResponseJson(true, "Runtime table updated"));
+}
+
 async function addNewVideo(req, res) {
   const category = sanitizeCategory(req.body.category);
   if (!category) {
@@ -170,32 +230,63 @@ async function updateEntry(req, res) {
   lease_expire_ts.setTime(lease_expire_ts.getTime() + (2*60*60*1000));
   const now = new Date().toISOString();
 
+  const user_id = req.body.user_id;
+  const release = !!req.body.release;
   const queue_ref = getCategoryPrivateDb(category).child("new_vids");
-  const existing_vids = (await queue_ref.once("value")).val();
-  const all_sets = new Array<Promise<void>>;
-  const updated_ids = new Array<string>;
-  if (req.body.video_ids.length != 1) {
-    return res.status(400).send(makeResponseJson(false, "only supports one video_ids"));
-  }
-  for (const vid of req.body.video_ids) {
-    if (vid in existing_vids) {
-      updated_ids.push(vid);
-      if (existing_vids[vid].lease_expires > now) {
-        return res.status(403).send(
-          makeResponseJson(false, `${vid} leased until ${existing_vids[vid].lease_expires}`));
+
+  // Each video is leased or released in its own transaction so two workers
+  // can never both be granted it, and a video deleted from the queue is not
+  // written back. Videos leased by another worker are skipped so the rest
+  // of a batch can still be claimed. A worker may renew or release its own
+  // lease.
+  const results = await Promise.all(req.body.video_ids.map(
+    (vid : string) => queue_ref.child(vid).transaction((entry) => {
+      if (entry === null) {
+        // Not in the queue, or not in the local cache yet. Writing null
+        // changes nothing, and the server reruns this with its value if the
+        // entry does exist.
+        return null;
+      }
+
+      const owned = entry.vast_instance === user_id;
+      if (entry.lease_expires > now && !owned) {
+        return;
       }
 
-      all_sets.push(queue_ref.child(vid).set(
-        {...existing_vids[vid],
-          vast_instance: req.body.user_id,
-          lease_expires: lease_expire_ts.toISOString(),
-        }));
+      if (release) {
+        if (!owned) {
+          return;
+        }
+        return {...entry, vast_instance: "", lease_expires: ""};
+      }
+
+      return {...entry,
+        vast_instance: user_id,
+        lease_expires: lease_expire_ts.toISOString(),
+      };
+    })));
+
+  const updated_ids = new Array<string>;
+  const leased_ids = new Array<string>;
+  req.body.video_ids.forEach((vid : string, i : number) => {
+    const {committed, snapshot} = results[i];
+    if (!snapshot.exists()) {
+      return;
     }
-  }
+    if (committed) {
+      updated_ids.push(vid);
+    } else if (snapshot.val().lease_expires > now &&
+               snapshot.val().vast_instance !== user_id) {
+      leased_ids.push(vid);
+    }
+  });
 
-  await Promise.all(all_sets);
+  if (updated_ids.length === 0 && leased_ids.length > 0) {
+    return res.status(403).send(
+      makeResponseJson(false, `${leased_ids.join(', ')} already leased`));
+  }
 
-  return res.status(200).send(makeResponseJson(true, "Items updated", {updated_ids}));
+  return res.status(200).send(makeResponseJson(true, "Items updated", {updated_ids, leased_ids}));
 }
 
 const video_queue = jsonOnRequest(
@@ -220,7 +311,11 @@ const video_queue = jsonOnRequest(
 const vast = jsonOnRequest(
   {cors: true, region: [Constants.GCP_REGION]},
   async (req, res) => {
-    if (req.method === "DELETE") {
+    if (req.method === "GET") {
+      return getRuntimeTable(req, res);
+    } else if (req.method === "PATCH") {
+      return addRuntimeRows(req, res);
+    } else if (req.method === "DELETE") {
       return removeVastInstance(req, res);
     }
 
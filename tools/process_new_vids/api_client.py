@@ -0,0 +1,166 @@
+# Client for the Cloud Run endpoints the worker talks to.
+#
+# All calls share one pooled requests.Session so the TLS connection to each
+# endpoint is kept alive across videos. Connection errors and 5xx responses
+# are retried with jittered exponential backoff, but only for calls that are
+# safe to repeat. Latency is recorded per endpoint and logged at exit.
+
+import collections
+import json
+import logging
+import random
+import time
+import zlib
+
+import requests
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+
+
+class ApiClient:
+    def __init__(self, api_base_url, auth_params, max_attempts=5,
+                 backoff_s=1, max_backoff_s=30, timeout_s=120):
+        self._api_base_url = api_base_url
+        self._auth_params = auth_params
+        self._max_attempts = max_attempts
+        self._backoff_s = backoff_s
+        self._max_backoff_s = max_backoff_s
+        self._timeout_s = timeout_s
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=8)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._latencies = collections.defaultdict(list)
+        self._retries = collections.Counter()
+        self._failures = collections.Counter()
+
+    def make_endpoint_url(self, endpoint):
+        # A base url with a scheme, like local_api_server.py's
+        # http://localhost:8080, routes endpoints by path. Cloud Run gives
+        # each endpoint its own subdomain instead.
+        if "://" in self._api_base_url:
+            return f"{self._api_base_url.rstrip('/')}/{endpoint}"
+        return f"https://{endpoint}-{self._api_base_url}"
+
+    def get(self, endpoint, params=None):
+        return self._request("GET", endpoint, idempotent=True,
+                             params={**self._auth_params, **(params or {})})
+
+    def patch(self, endpoint, body, idempotent=False):
+        return self._request("PATCH", endpoint, idempotent=idempotent,
+                             json={**self._auth_params, **body})
+
+    def put(self, endpoint, body):
+        # Uploading the same transcript twice overwrites it with itself.
+        return self._request("PUT", endpoint, idempotent=True,
+                             json={**self._auth_params, **body})
+
+    def put_gzip_json(self, endpoint, body, compresslevel=6):
+        """PUTs `body` as a gzip Content-Encoded json stream.
+
+        The json is serialized and compressed incrementally while it is
+        sent so neither the full json string nor the compressed copy is
+        ever held in memory. The Cloud Functions body parser inflates gzip
+        before the handler sees it.
+
+        Returns (response, stats) where stats has the raw and compressed
+        byte counts of the last attempt.
+        """
+        stats = {}
+
+        def chunks():
+            compressor = zlib.compressobj(
+                compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            raw_bytes = compressed_bytes = 0
+            encoder = json.JSONEncoder(ensure_ascii=False)
+            for piece in encoder.iterencode({**self._auth_params, **body}):
+                data = piece.encode()
+                raw_bytes += len(data)
+                out = compressor.compress(data)
+                if out:
+                    compressed_bytes += len(out)
+                    yield out
+            out = compressor.flush()
+            compressed_bytes += len(out)
+            yield out
+            stats.update(raw_bytes=raw_bytes,
+                         compressed_bytes=compressed_bytes)
+
+        # Uploading the same transcript twice overwrites it with itself.
+        response = self._request(
+            "PUT", endpoint, idempotent=True, data_fn=chunks,
+            headers={'Content-Type': 'application/json',
+                     'Content-Encoding': 'gzip'})
+        return response, stats
+
+    def delete(self, endpoint, body):
+        # Removing an already removed item is a no-op on the server.
+        return self._request("DELETE", endpoint, idempotent=True,
+                             json={**self._auth_params, **body})
+
+    def log_stats(self):
+        for key, latencies in sorted(self._latencies.items()):
+            latencies = sorted(latencies)
+            logger.info(
+                f"{key}: {len(latencies)} requests, "
+                f"p50 {latencies[len(latencies) // 2]:.3f}s, "
+                f"max {latencies[-1]:.3f}s, "
+                f"mean {sum(latencies) / len(latencies):.3f}s, "
+                f"{self._retries[key]} retries, "
+                f"{self._failures[key]} failures")
+
+    def _should_retry(self, idempotent, response=None, error=None):
+        if error is not None:
+            # A request that never connected was never seen by the server.
+            return idempotent or isinstance(
+                error, requests.exceptions.ConnectTimeout)
+        if idempotent:
+            return response.status_code >= 500
+        # Cloud Run answers 503 before the request reaches the function.
+        return response.status_code == 503
+
+    def _sleep_backoff(self, attempt):
+        # Full jitter keeps many workers from retrying in lockstep.
+        time.sleep(random.uniform(
+            0, min(self._max_backoff_s, self._backoff_s * 2 ** attempt)))
+
+    def _request(self, method, endpoint, idempotent, data_fn=None,
+                 **kwargs):
+        """Sends the request, retrying when allowed.
+
+        A streamed body cannot be replayed, so pass `data_fn` returning a
+        fresh iterator of body chunks for each attempt instead of `data`.
+        """
+        key = f"{method} {endpoint}"
+        url = self.make_endpoint_url(endpoint)
+        for attempt in range(self._max_attempts):
+            if data_fn:
+                kwargs['data'] = data_fn()
+            start = time.time()
+            try:
+                response = self._session.request(
+                    method, url, timeout=self._timeout_s, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._latencies[key].append(time.time() - start)
+                if (attempt + 1 == self._max_attempts or
+                        not self._should_retry(idempotent, error=e)):
+                    self._failures[key] += 1
+                    raise
+                logger.warning(f"{key} attempt {attempt + 1} failed: {e}")
+            else:
+                self._latencies[key].append(time.time() - start)
+                if (attempt + 1 == self._max_attempts or
+                        not self._should_retry(idempotent,
+                                               response=response)):
+                    if response.status_code >= 500:
+                        self._failures[key] += 1
+                    return response
+                logger.warning(f"{key} attempt {attempt + 1} returned "
+                               f"{response.status_code}: {response.text}")
+
+            self._retries[key] += 1
+            self._sleep_backoff(attempt)
@@ -0,0 +1,158 @@
+# Local audio cache for --cache mode.
+#
+# Entries are keyed by video id and the itag of the stream that was
+# downloaded so a different stream selection never aliases an old file. An
+# index.json next to the files records size and last access time, and the
+# least recently used entries are evicted once the cache exceeds its byte
+# budget. Entries in use by a running transcription are pinned and never
+# evicted.
+
+import json
+import logging
+import os
+import threading
+import time
+
+from ranged_download import PROGRESS_SUFFIX, progress_path
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+PARTIAL_SUFFIX = ".partial"
+
+
+class AudioCache:
+    def __init__(self, cache_dir, budget_bytes):
+        self._dir = cache_dir
+        self._budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._pins = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._entries = self._load_index()
+
+    @staticmethod
+    def make_key(video_id, itag):
+        return f"{video_id}.{itag}"
+
+    def fetch(self, video_id, itag, download_fn):
+        """Returns a pinned path to the audio for `video_id` and `itag`.
+
+        On a miss, `download_fn(dest_path)` must write the audio to
+        `dest_path`. The caller must unpin() the path when done with it.
+        """
+        key = self.make_key(video_id, itag)
+        path = self._dir.joinpath(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and path.exists():
+                self.hits += 1
+                entry['last_access'] = time.time()
+                self._pin(path)
+                self._write_index()
+                logger.info(f"Audio cache hit for {key}")
+                return path
+            self.misses += 1
+
+        logger.info(f"Audio cache miss for {key}")
+        partial_path = self._dir.joinpath(key + PARTIAL_SUFFIX)
+        try:
+            download_fn(partial_path)
+        except BaseException:
+            if not progress_path(partial_path).exists():
+                partial_path.unlink(missing_ok=True)
+            raise
+        os.replace(partial_path, path)
+
+        with self._lock:
+            now = time.time()
+            self._entries[key] = {
+                'video_id': video_id,
+                'itag': itag,
+                'num_bytes': path.stat().st_size,
+                'created': now,
+                'last_access': now,
+            }
+            self._pin(path)
+            self._evict()
+            self._write_index()
+        return path
+
+    def unpin(self, path):
+        with self._lock:
+            count = self._pins.get(path, 0) - 1
+            if count > 0:
+                self._pins[path] = count
+            else:
+                self._pins.pop(path, None)
+            self._evict()
+            self._write_index()
+
+    def size_bytes(self):
+        with self._lock:
+            return sum(e['num_bytes'] for e in self._entries.values())
+
+    def log_stats(self):
+        logger.info(f"Audio cache: {self.hits} hits, {self.misses} misses, "
+                    f"{self.evictions} evictions "
+                    f"({self.evicted_bytes} bytes), "
+                    f"{len(self._entries)} entries using "
+                    f"{self.size_bytes()} of {self._budget_bytes} bytes")
+
+    def _pin(self, path):
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def _evict(self):
+        total = sum(e['num_bytes'] for e in self._entries.values())
+        lru = sorted(self._entries.items(),
+                     key=lambda kv: kv[1]['last_access'])
+        for key, entry in lru:
+            if total <= self._budget_bytes:
+                break
+            path = self._dir.joinpath(key)
+            if path in self._pins:
+                continue
+            path.unlink(missing_ok=True)
+            del self._entries[key]
+            total -= entry['num_bytes']
+            self.evictions += 1
+            self.evicted_bytes += entry['num_bytes']
+            logger.info(f"Evicted {key} ({entry['num_bytes']} bytes) from "
+                        "audio cache")
+
+    def _load_index(self):
+        try:
+            with open(self._dir.joinpath(INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entries = {}
+
+        # Drop index entries whose files are gone and files, including
+        # partial downloads from a killed run, that the index does not know.
+        # A partial download with a record of its finished ranges is kept
+        # so a later attempt resumes it.
+        entries = {key: entry for key, entry in entries.items()
+                   if self._dir.joinpath(key).exists()}
+        for path in self._dir.iterdir():
+            if path.name == INDEX_FILE or path.name in entries:
+                continue
+            if progress_path(path).exists() or (
+                    path.suffix == PROGRESS_SUFFIX and
+                    path.with_suffix("").exists()):
+                continue
+            logger.info(f"Removing untracked cache file {path.name}")
+            path.unlink(missing_ok=True)
+        return entries
+
+    def _write_index(self):
+        index_path = self._dir.joinpath(INDEX_FILE)
+        tmp_path = self._dir.joinpath(INDEX_FILE + PARTIAL_SUFFIX)
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, index_path)
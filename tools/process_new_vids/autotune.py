@@ -0,0 +1,207 @@
+# Picks the ASR compute_type and batch size for the GPU the worker got.
+#
+# functions-python/main.py rents any vast.ai machine with 8GB or more of
+# VRAM, from Pascal cards without fast float16 to 48GB Ampere ones, so one
+# fixed setting either leaves most of a big card idle or runs a small one
+# out of memory. tune() reads the compute capability and free memory before
+# any model loads and picks the fastest compute type the card supports, then
+# the largest batch that fits next to the alignment and diarization models.
+# The memory figures are estimates. calibrate() optionally checks the batch
+# size with a real ASR run and halves it until it stops running out of
+# memory.
+
+import logging
+import math
+import pathlib
+import time
+
+logger = logging.getLogger(__name__)
+
+GB = 1024**3
+
+PRIME_AUDIO = pathlib.Path(__file__).parent.joinpath("prime_model.mp4")
+
+# Approximate float16 ASR weights and activation memory per batch item in
+# GB. Unknown models are assumed to be large.
+_MODEL_GB = {
+    "tiny": (0.08, 0.02),
+    "base": (0.15, 0.03),
+    "small": (0.5, 0.08),
+    "medium": (1.5, 0.2),
+    "large-v3-turbo": (1.6, 0.3),
+    "large": (3.1, 0.35),
+}
+
+# Size of weights relative to float16.
+_WEIGHT_SCALE = {
+    "float32": 2,
+    "float16": 1,
+    "bfloat16": 1,
+    "int8_float16": 0.55,
+    "int8_float32": 0.55,
+    "int8": 0.55,
+}
+
+# The wav2vec2 alignment model and the pyannote pipeline are resident on the
+# GPU too, and diarization of one video overlaps ASR of the next.
+_OTHER_MODELS_GB = 3
+# Left free for allocator fragmentation and cuDNN workspaces.
+_HEADROOM = 0.9
+MAX_BATCH_SIZE = 32
+CPU_COMPUTE_TYPE = "int8"
+CPU_BATCH_SIZE = 8
+
+# The whisper pipelines cut audio into 30 second chunks, one per batch item.
+_CHUNK_S = 30
+
+
+def cuda_devices():
+    """Returns "cuda:N" for every visible GPU."""
+    try:
+        import torch
+    except ImportError:
+        return []
+    if not torch.cuda.is_available():
+        return []
+    return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+
+
+def probe_gpu(device="cuda:0"):
+    """Returns facts about a CUDA device, or None if there is none."""
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+
+    index = int(device.partition(":")[2] or 0)
+    free_bytes, total_bytes = torch.cuda.mem_get_info(index)
+    return {
+        'device': device,
+        'name': torch.cuda.get_device_name(index),
+        'capability': list(torch.cuda.get_device_capability(index)),
+        'free_bytes': free_bytes,
+        'total_bytes': total_bytes,
+    }
+
+
+def compute_types_for(capability):
+    """Compute types the card runs efficiently, fastest first."""
+    if tuple(capability) >= (7, 0):
+        # Tensor cores. int8 weights only if float16 does not fit.
+        return ["float16", "int8_float16"]
+    if tuple(capability) >= (6, 1):
+        # Pascal has fast int8 (DP4A) but slow float16.
+        return ["int8_float32"]
+    return ["float32"]
+
+
+def plan(gpu, model, compute_type=None, batch_size=None):
+    """Returns (compute_type, batch_size) for `model` on `gpu`.
+
+    Settings already given by the user are kept.
+    """
+    weights_gb, item_gb = _MODEL_GB.get(model, _MODEL_GB["large"])
+    candidates = ([compute_type] if compute_type
+                  else compute_types_for(gpu['capability']))
+    usable_gb = gpu['free_bytes'] * _HEADROOM / GB
+
+    for candidate in candidates:
+        fixed_gb = (weights_gb * _WEIGHT_SCALE.get(candidate, 1) +
+                    _OTHER_MODELS_GB)
+        per_item_gb = item_gb * (2 if candidate == "float32" else 1)
+        fits = math.floor((usable_gb - fixed_gb) / per_item_gb)
+        if batch_size:
+            if fits >= batch_size:
+                return candidate, batch_size
+        elif fits >= 1:
+            return candidate, min(fits, MAX_BATCH_SIZE)
+
+    # Nothing fits by the estimate. Try the smallest settings anyway.
+    logger.warning(f"{model} may not fit in {usable_gb:.1f}GB of free GPU "
+                   "memory")
+    return candidates[-1], batch_size or 1
+
+
+def tune(args):
+    """Fills in args.compute_type and args.batch_size when unset.
+
+    Every replica gets the same settings, so they are planned for the GPU
+    with the least free memory, split between its `replicas_per_device`.
+    Returns what was probed and chosen, for the metrics records.
+    """
+    requested = {'compute_type': args.compute_type,
+                 'batch_size': args.batch_size}
+    gpus = [gpu for gpu in (probe_gpu(device) for device in args.devices
+                            if device.startswith("cuda"))
+            if gpu is not None]
+    gpu = None
+    if gpus:
+        gpu = min(gpus, key=lambda g: g['free_bytes'])
+        gpu = {**gpu, 'free_bytes': gpu['free_bytes'] //
+               max(1, args.replicas_per_device)}
+    if gpu is None:
+        args.compute_type = args.compute_type or CPU_COMPUTE_TYPE
+        args.batch_size = args.batch_size or CPU_BATCH_SIZE
+    else:
+        args.compute_type, args.batch_size = plan(
+            gpu, args.model, args.compute_type, args.batch_size)
+
+    logger.info(f"Using compute_type {args.compute_type} and batch size "
+                f"{args.batch_size}" +
+                (f" on {gpu['name']} (compute capability "
+                 f"{gpu['capability'][0]}.{gpu['capability'][1]}, "
+                 f"{gpu['free_bytes'] / GB:.1f} of "
+                 f"{gpu['total_bytes'] / GB:.1f}GB free)" if gpu else ""))
+    return {
+        'gpu': gpu,
+        'gpus': gpus,
+        'requested': requested,
+        'compute_type': args.compute_type,
+        'batch_size': args.batch_size,
+    }
+
+
+def _is_out_of_memory(error):
+    # torch raises OutOfMemoryError, ctranslate2 a RuntimeError saying
+    # "CUDA failed with error out of memory".
+    return "out of memory" in str(error).lower()
+
+
+def calibrate(engine, audio_path=PRIME_AUDIO):
+    """Runs ASR on a full batch of audio, halving the batch size on OOM.
+
+    Leaves the working batch size in engine.batch_size and returns
+    {batch_size, asr_s, attempts}.
+    """
+    import numpy
+    import torch
+
+    clip = engine.load_audio(audio_path)
+    attempts = []
+    while True:
+        # Repeat the clip so every batch item gets a chunk.
+        num_samples = engine.batch_size * _CHUNK_S * engine.sample_rate
+        audio = numpy.tile(clip, math.ceil(num_samples / len(clip)))
+        start = time.time()
+        try:
+            engine.asr(audio)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e) or engine.batch_size == 1:
+                raise
+            attempts.append({'batch_size': engine.batch_size, 'oom': True})
+            logger.warning(f"Batch size {engine.batch_size} ran out of GPU "
+                           "memory. Halving it.")
+            engine.batch_size //= 2
+            torch.cuda.empty_cache()
+            continue
+
+        asr_s = time.time() - start
+        attempts.append({'batch_size': engine.batch_size, 'oom': False,
+                         'asr_s': asr_s})
+        logger.info(f"Calibrated batch size {engine.batch_size}: "
+                    f"{len(audio) / engine.sample_rate:.0f} seconds of audio "
+                    f"in {asr_s:.1f} seconds")
+        return {'batch_size': engine.batch_size, 'asr_s': asr_s,
+                'attempts': attempts}
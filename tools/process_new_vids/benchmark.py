@@ -0,0 +1,221 @@
+#!python
+# Offline benchmark of the worker's transcription path.
+#
+# Runs the same WhisperXEngine stages transcribe_worker.py runs on the
+# bundled prime_model.mp4 and audio.wav, and on long synthetic inputs made by
+# looping audio.wav with ffmpeg, without touching YouTube or the API. Every
+# input appends one json line to the results file with the real time factor,
+# CPU time and peak memory of each stage and the size of the transcript the
+# worker would upload, tagged with the model and machine it ran on.
+#
+# The defaults run CPU-only with the tiny model so it works on any Linux box.
+# Diarization needs the gated pyannote models so it only runs with
+# --hf_token. To compare settings, run again with different flags and the
+# same --output. --no-mmap_audio decodes into memory like the worker used
+# to, for comparing peak memory against memory mapped audio:
+#
+#   ./benchmark.py --hours 1
+#   ./benchmark.py --hours 1 --no-mmap_audio
+#   ./benchmark.py --device cuda --model large-v3-turbo \
+#       --compute_type float16 --hf_token=...
+
+import argparse
+import datetime
+import gc
+import gzip
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import time
+
+from metrics import PeakMemorySampler, machine_info
+import stream_decode
+import transcript_codec
+from whisperx_engine import WhisperXEngine
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = pathlib.Path(__file__).parent
+DEFAULT_INPUTS = [APP_DIR.joinpath("prime_model.mp4"),
+                  APP_DIR.joinpath("audio.wav")]
+
+
+def make_synthetic_input(source, hours, workdir):
+    """Loops `source` into a 16kHz mono wav `hours` long. Reused if present."""
+    path = workdir.joinpath(f"{source.stem}_{hours:g}h.wav")
+    if path.exists():
+        return path
+
+    logger.info(f"Generating {hours:g} hours of audio from {source.name}")
+    partial_path = workdir.joinpath(f"{source.stem}_{hours:g}h.partial.wav")
+    subprocess.run([
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        "-stream_loop", "-1", "-i", str(source),
+        "-t", str(hours * 3600), "-ac", "1", "-ar", "16000",
+        str(partial_path)], check=True)
+    os.replace(partial_path, path)
+    return path
+
+
+def benchmark_input(engine, path, sampler, pcm_path=None):
+    """Runs every stage on `path`, decoding it to `pcm_path` if given."""
+    stages = {}
+
+    def timed(name, fn, *args):
+        sampler.start(name)
+        start = time.time()
+        process_cpu_start = time.process_time()
+        result = fn(*args)
+        stages[name] = {
+            'wall_s': time.time() - start,
+            'process_cpu_s': time.process_time() - process_cpu_start,
+            **sampler.stop(name),
+        }
+        logger.info(f"{path.name}: {name} took "
+                    f"{stages[name]['wall_s']:.1f} seconds")
+        return result
+
+    def decode(path):
+        if pcm_path:
+            path = stream_decode.decode_file(path, pcm_path)
+        return engine.load_audio(path)
+
+    start = time.time()
+    audio = timed('decode', decode, path)
+    audio_s = len(audio) / engine.sample_rate
+    asr_result = timed('asr', engine.asr, audio)
+    result = timed('align', engine.align, asr_result, audio)
+    if engine.diarize_model:
+        speaker_turns = timed('diarize', engine.diarize, audio)
+        result = timed('assign_speakers', engine.assign_speakers,
+                       speaker_turns, result)
+    total_s = time.time() - start
+
+    del audio
+    gc.collect()
+    if pcm_path:
+        pcm_path.unlink(missing_ok=True)
+
+    for stage in stages.values():
+        stage['rtf'] = stage['wall_s'] / audio_s
+
+    raw = json.dumps(result, ensure_ascii=False).encode()
+    compact = json.dumps(transcript_codec.encode(result), ensure_ascii=False,
+                         separators=(",", ":")).encode()
+    return {
+        'input': path.name,
+        'audio_s': audio_s,
+        'total_s': total_s,
+        'rtf': total_s / audio_s,
+        'segments': len(result['segments']),
+        'words': sum(len(s.get('words', [])) for s in result['segments']),
+        'stages': stages,
+        'output_bytes': {
+            'whisperx_json': len(raw),
+            'whisperx_json_gzip': len(gzip.compress(raw)),
+            'compact_json': len(compact),
+            'compact_json_gzip': len(gzip.compress(compact)),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Transcription benchmark.',
+        description=('Measures per stage real time factor, peak memory and '
+                     'output size of the worker transcription path on local '
+                     'audio files'))
+    parser.add_argument('inputs', metavar="AUDIO_FILE", nargs='*',
+                        type=pathlib.Path, default=DEFAULT_INPUTS,
+                        help=('Audio or video files to transcribe. Defaults '
+                              'to the bundled prime_model.mp4 and audio.wav'))
+    parser.add_argument('--hours', dest='hours', metavar="HOURS", type=float,
+                        nargs='*', default=[1, 3, 5],
+                        help=('Also benchmark synthetic inputs of these '
+                              'lengths made by looping --source'))
+    parser.add_argument('--source', dest='source', metavar="AUDIO_FILE",
+                        type=pathlib.Path,
+                        default=APP_DIR.joinpath("audio.wav"),
+                        help='Audio looped into the synthetic inputs')
+    parser.add_argument('-w', '--workdir', dest='workdir',
+                        metavar="WORK_DIR", type=pathlib.Path,
+                        default=pathlib.Path("/tmp/transcribe_benchmark"),
+                        help='Where synthetic inputs are generated')
+    parser.add_argument('-o', '--output', dest='output',
+                        metavar="JSONL_FILE", type=pathlib.Path,
+                        help=('Results are appended here. Defaults to '
+                              'WORK_DIR/benchmark.jsonl'))
+    parser.add_argument('-t', '--threads', dest='threads', metavar="THREADS",
+                        type=int, default=os.cpu_count(),
+                        help='number of threads to run whisper on')
+    parser.add_argument('-x', '--hf_token', dest='hf_token',
+                        metavar="HF_TOKEN", type=str,
+                        help=('HuggingFace token for the diarization models. '
+                              'Diarization is skipped without one'))
+    parser.add_argument('-m', '--model', dest='model', metavar="MODEL_NAME",
+                        type=str, default="tiny",
+                        help='Name of whisper model to use')
+    parser.add_argument('--compute_type', dest='compute_type',
+                        metavar="COMPUTE_TYPE", type=str, default="int8",
+                        help='Compute type for the whisper model')
+    parser.add_argument('--device', dest='device', metavar="DEVICE",
+                        type=str, default="cpu",
+                        help='Torch device to run the models on')
+    parser.add_argument('--batch_size', dest='batch_size',
+                        metavar="BATCH_SIZE", type=int, default=8,
+                        help='Batch size for ASR inference')
+    parser.add_argument('--mmap_audio', dest='mmap_audio',
+                        help=('Decode to a PCM file and memory map it as the '
+                              'worker does'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    # machine_info() tags records with whether the engine was used.
+    parser.set_defaults(engine=True)
+    args = parser.parse_args()
+    args.devices = [args.device]
+
+    logging.basicConfig(level=logging.INFO)
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    output = args.output or args.workdir.joinpath("benchmark.jsonl")
+
+    inputs = list(args.inputs) + [
+        make_synthetic_input(args.source, hours, args.workdir)
+        for hours in args.hours]
+
+    sampler = PeakMemorySampler().start_sampler()
+    sampler.start('load')
+    start = time.time()
+    engine = WhisperXEngine(
+        model=args.model,
+        compute_type=args.compute_type,
+        device=args.device,
+        threads=args.threads,
+        hf_token=args.hf_token,
+        batch_size=args.batch_size,
+        diarize=bool(args.hf_token))
+    load = {'wall_s': time.time() - start, **sampler.stop('load')}
+
+    machine = machine_info(args)
+    for path in inputs:
+        record = {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **benchmark_input(
+                engine, path, sampler,
+                args.mmap_audio and args.workdir.joinpath(
+                    f"{path.stem}{stream_decode.SUFFIX}")),
+            'mmap_audio': args.mmap_audio,
+            'load': load,
+            'machine': machine,
+        }
+        with open(output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(json.dumps(record), flush=True)
+
+    sampler.close()
+    logger.info(f"Results appended to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Time budget of a worker instance.
+#
+# lysine_protocol.sh destroys the instance a fixed number of minutes after
+# it starts whether or not the worker is done. A video still transcribing
+# then is wasted GPU time and stays leased for 2 hours. TimeBudget predicts
+# how long a video takes from its duration and turns away videos that
+# cannot finish before the deadline, counting the work already taken on.
+# Once even a typical video would not fit, the worker stops leasing, hands
+# back what it holds and exits so the instance is destroyed early rather
+# than billing until the deadline.
+#
+# Videos overlap in the pipeline, so the time from a video's start to its
+# finish includes waiting on the stages of other videos, and the sum of
+# those times is well over the wall time they took. The budget adds up
+# predictions one after another, so it learns from what each video cost
+# the pipeline as measured by CompletionClock instead.
+
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionClock:
+    """Charges each finished video the pipeline time it took.
+
+    A video is charged the time since the previous video finished, or
+    since it started if the pipeline sat idle in between. With the pipeline
+    full that is the interval between completions, so the charges add up to
+    the wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_finish = None
+
+    def charge(self, start_time, now=None):
+        """Returns the seconds charged to a video started at `start_time`."""
+        now = time.time() if now is None else now
+        with self._lock:
+            since = start_time
+            if self._last_finish is not None:
+                since = max(since, self._last_finish)
+            self._last_finish = now
+        return max(0, now - since)
+
+
+class TimeBudget:
+    """Admits videos while the predicted work fits before the deadline.
+
+    A video is predicted to take `overhead_s` plus `rtf` seconds per second
+    of audio. `rtf` starts at the given estimate and follows the measured
+    rate of finished videos. Predictions are padded by `safety` since a
+    video that overruns is lost entirely. A `budget_s` of None admits
+    everything.
+    """
+
+    def __init__(self, budget_s=None, rtf=0.3, overhead_s=60, safety=1.2,
+                 smoothing=0.3, deadline=None):
+        self._deadline = deadline
+        if deadline is None and budget_s is not None:
+            self._deadline = time.time() + budget_s
+        self.rtf = rtf
+        # Running estimate of the processing time of one video, before its
+        # duration is known.
+        self.video_s = None
+        self._overhead_s = overhead_s
+        self._safety = safety
+        self._smoothing = smoothing
+        self._lock = threading.Lock()
+        self._committed = {}
+
+    def remaining_s(self):
+        if self._deadline is None:
+            return math.inf
+        return self._deadline - time.time()
+
+    def set_estimate(self, overhead_s, rtf):
+        """Replaces the initial guess, e.g. with a learned one."""
+        with self._lock:
+            self._overhead_s = overhead_s
+            self.rtf = rtf
+
+    def predict_s(self, duration_s):
+        return self._overhead_s + (duration_s or 0) * self.rtf
+
+    def can_take_more(self):
+        """Whether a typical video could still finish after the work held."""
+        with self._lock:
+            typical_s = self.video_s or self._overhead_s
+            return ((sum(self._committed.values()) + typical_s) *
+                    self._safety <= self.remaining_s())
+
+    def admit(self, key, duration_s):
+        """Takes on `key` if it can finish in time along with the rest."""
+        with self._lock:
+            predicted_s = self.predict_s(duration_s)
+            needed_s = (sum(self._committed.values()) +
+                        predicted_s) * self._safety
+            remaining_s = self.remaining_s()
+            if needed_s > remaining_s:
+                logger.info(f"Skipping {key}: {duration_s} seconds of audio "
+                            f"needs about {needed_s:.0f} seconds with the "
+                            f"work ahead of it but {remaining_s:.0f} are "
+                            "left")
+                return False
+            self._committed[key] = predicted_s
+            return True
+
+    def finish(self, key, duration_s=None, elapsed_s=None):
+        """Returns `key`'s share of the budget and learns from its runtime.
+
+        `elapsed_s` is the pipeline time the video took, from
+        CompletionClock.charge().
+        """
+        with self._lock:
+            self._committed.pop(key, None)
+            if not duration_s or elapsed_s is None:
+                return
+            measured = max(0, elapsed_s - self._overhead_s) / duration_s
+            self.rtf += self._smoothing * (measured - self.rtf)
+            if self.video_s is None:
+                self.video_s = elapsed_s
+            else:
+                self.video_s += self._smoothing * (elapsed_s - self.video_s)
@@ -0,0 +1,90 @@
+# Per-video stage checkpoints.
+#
+# ASR on a 3 hour meeting is the expensive part of the pipeline, so each
+# stage's result is written under WORK_DIR/checkpoints/{video_id}/ as it
+# completes. A manifest records the model config the results came from and
+# which stages are done. A retry, in this process or a later one, skips
+# every stage whose result is already saved. Results from a different model
+# config are discarded rather than mixed in.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _write_json_atomic(path, obj):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class CheckpointStore:
+    def __init__(self, root_dir):
+        self._root_dir = root_dir
+        self._root_dir.mkdir(parents=True, exist_ok=True)
+
+    def open(self, video_id, config):
+        return VideoCheckpoint(self._root_dir.joinpath(video_id), config)
+
+
+class VideoCheckpoint:
+    def __init__(self, checkpoint_dir, config):
+        self._dir = checkpoint_dir
+        self._config_key = hashlib.sha256(
+            json.dumps(config, sort_keys=True).encode()).hexdigest()
+        self._manifest = {
+            'config': config,
+            'config_key': self._config_key,
+            'stages': {},
+        }
+
+        try:
+            with open(self._dir.joinpath(MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = None
+
+        if manifest and manifest.get('config_key') == self._config_key:
+            self._manifest = manifest
+            if self.stages():
+                logger.info(f"Found checkpoints in {self._dir} for stages "
+                            f"{', '.join(self.stages())}")
+        elif manifest:
+            logger.info(f"Discarding checkpoints in {self._dir} made with "
+                        f"config {manifest.get('config')}")
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def stages(self):
+        return list(self._manifest['stages'])
+
+    def has(self, stage):
+        return stage in self._manifest['stages']
+
+    def load(self, stage):
+        with open(self._dir.joinpath(
+                self._manifest['stages'][stage]['file'])) as f:
+            return json.load(f)
+
+    def save(self, stage, result):
+        self._dir.mkdir(parents=True, exist_ok=True)
+        filename = f"{stage}.json"
+        _write_json_atomic(self._dir.joinpath(filename), result)
+
+        # Only mark the stage done once its result is fully on disk.
+        self._manifest['stages'][stage] = {
+            'file': filename,
+            'completed': time.time(),
+        }
+        _write_json_atomic(self._dir.joinpath(MANIFEST_FILE), self._manifest)
+
+    def clear(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+        self._manifest['stages'] = {}
@@ -0,0 +1,228 @@
+# Splits long meetings into chunks that are transcribed in parallel.
+#
+# One engine works through a 4 hour meeting serially however many cores or
+# GPUs the machine has. With several engine replicas, transcribe_chunked()
+# cuts the audio at the quietest point near every `chunk_s` seconds and runs
+# the whole asr, align, diarize and assign_speakers pipeline on each chunk,
+# borrowing whichever replica is free from the same pools the per-video
+# stages use.
+#
+# Chunks overlap by `overlap_s` so no word is cut in half. Each chunk owns
+# the audio between its cut points and a segment is kept from the chunk
+# that owns its midpoint, which drops the duplicates from the overlaps.
+# Diarization labels are only consistent within a chunk, so local speakers
+# are matched to global ones by the cosine similarity of their pyannote
+# embeddings, or by how much they talk at the same time in the overlap when
+# embeddings are unavailable.
+
+import concurrent.futures
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Window used to find the quietest place to cut.
+_CUT_WINDOW_S = 0.5
+
+
+def _quietest(audio, lo, hi, window):
+    num_windows = (hi - lo) // window
+    if num_windows < 1:
+        return (lo + hi) // 2
+    frames = audio[lo:lo + num_windows * window].reshape(num_windows, window)
+    energy = numpy.mean(numpy.square(frames, dtype=numpy.float32), axis=1)
+    return lo + int(numpy.argmin(energy)) * window + window // 2
+
+
+def plan_chunks(audio, sample_rate, chunk_s=1800, overlap_s=30,
+                search_s=120):
+    """Returns (start, end, own_start, own_end) sample ranges of chunks.
+
+    Each chunk spans [start, end) and owns [own_start, own_end), which
+    tile the audio. Audio under 1.5 chunks long is left whole.
+    """
+    n = len(audio)
+    chunk = max(1, int(chunk_s * sample_rate))
+    # Searching no further back than half a chunk keeps every cut at least
+    # half a chunk past the previous one.
+    search = min(int(search_s * sample_rate), chunk // 2)
+    half_overlap = int(overlap_s * sample_rate / 2)
+    window = int(_CUT_WINDOW_S * sample_rate)
+
+    cuts = []
+    pos = chunk
+    while pos < n - chunk // 2:
+        cut = _quietest(audio, max(0, pos - search), min(n, pos + search),
+                        window)
+        cuts.append(cut)
+        pos = cut + chunk
+
+    bounds = [0] + cuts + [n]
+    return [(max(0, own_start - half_overlap), min(n, own_end + half_overlap),
+             own_start, own_end)
+            for own_start, own_end in zip(bounds, bounds[1:])]
+
+
+def _cosine(a, b):
+    a = numpy.asarray(a, dtype=numpy.float32)
+    b = numpy.asarray(b, dtype=numpy.float32)
+    denom = numpy.linalg.norm(a) * numpy.linalg.norm(b)
+    return float(a @ b / denom) if denom else 0.0
+
+
+def _talk_overlap(turns_a, turns_b, lo, hi):
+    """Fraction of the lesser talker's time in [lo, hi) spent together."""
+    def clip(turns):
+        return [(max(lo, t['start']), min(hi, t['end'])) for t in turns
+                if t['end'] > lo and t['start'] < hi]
+    a = clip(turns_a)
+    b = clip(turns_b)
+    shared = sum(max(0, min(a_end, b_end) - max(a_start, b_start))
+                 for a_start, a_end in a for b_start, b_end in b)
+    least = min(sum(end - start for start, end in a),
+                sum(end - start for start, end in b))
+    return shared / least if least else 0.0
+
+
+def reconcile_speakers(chunks, threshold=0.5):
+    """Maps each chunk's speaker labels to globally consistent ones.
+
+    `chunks` is a list of {turns, embeddings, overlap} where turns are
+    {start, end, speaker} on the full timeline, embeddings is {speaker:
+    vector} or None and overlap is the (start_s, end_s) shared with the
+    previous chunk. Returns a {local: global} dict per chunk.
+    """
+    centroids = {}
+    global_turns = []
+    maps = []
+    for chunk in chunks:
+        turns = chunk['turns']
+        embeddings = chunk['embeddings'] or {}
+        local_speakers = sorted({t['speaker'] for t in turns} |
+                                set(embeddings))
+
+        scores = []
+        for local in local_speakers:
+            for speaker, (total, count) in centroids.items():
+                if local in embeddings and count:
+                    score = _cosine(embeddings[local], total / count)
+                else:
+                    lo, hi = chunk['overlap']
+                    score = _talk_overlap(
+                        [t for t in turns if t['speaker'] == local],
+                        [t for t in global_turns if t['speaker'] == speaker],
+                        lo, hi)
+                scores.append((score, local, speaker))
+
+        mapping = {}
+        for score, local, speaker in sorted(scores, reverse=True):
+            if score < threshold:
+                break
+            if local not in mapping and speaker not in mapping.values():
+                mapping[local] = speaker
+        for local in local_speakers:
+            if local not in mapping:
+                mapping[local] = f"SPEAKER_{len(centroids):02d}"
+                centroids[mapping[local]] = (0, 0)
+
+        for local, speaker in mapping.items():
+            if local in embeddings:
+                total, count = centroids[speaker]
+                centroids[speaker] = (
+                    total + numpy.asarray(embeddings[local],
+                                          dtype=numpy.float32), count + 1)
+        global_turns.extend({**t, 'speaker': mapping[t['speaker']]}
+                            for t in turns)
+        maps.append(mapping)
+    return maps
+
+
+def _shift(item, offset_s):
+    for key in ("start", "end"):
+        if item.get(key) is not None:
+            item[key] = round(item[key] + offset_s, 3)
+
+
+def stitch(results, chunks, speaker_maps, sample_rate):
+    """Joins per-chunk whisperx results into one on the full timeline."""
+    segments = []
+    for i, (result, (start, _, own_start, own_end), mapping) in enumerate(
+            zip(results, chunks, speaker_maps)):
+        offset_s = start / sample_rate
+        own_start_s = own_start / sample_rate
+        own_end_s = own_end / sample_rate
+        last = i == len(chunks) - 1
+        for segment in result["segments"]:
+            _shift(segment, offset_s)
+            for word in segment.get("words", []):
+                _shift(word, offset_s)
+                if "speaker" in word:
+                    word["speaker"] = mapping.get(word["speaker"],
+                                                  word["speaker"])
+            if "speaker" in segment:
+                segment["speaker"] = mapping.get(segment["speaker"],
+                                                 segment["speaker"])
+
+            seg_start = segment.get("start", own_start_s)
+            mid = (seg_start + segment.get("end", seg_start)) / 2
+            if own_start_s <= mid and (mid < own_end_s or last):
+                segments.append(segment)
+
+    return {
+        "segments": segments,
+        "word_segments": [word for segment in segments
+                          for word in segment.get("words", [])],
+        "language": results[0]["language"],
+    }
+
+
+def transcribe_chunked(gpu_pool, diarize_pool, audio, sample_rate, chunks,
+                       checkpoint=None, name=""):
+    """Runs the full pipeline on every chunk and stitches the results.
+
+    ASR and alignment borrow an engine from `gpu_pool` and diarization one
+    from `diarize_pool`, both stages.ReplicaPools of WhisperXEngines.
+    Finished chunks are saved to `checkpoint` as chunk0, chunk1, ... so a
+    retry only redoes the missing ones.
+    """
+    def run_chunk(i):
+        stage = f"chunk{i}"
+        if checkpoint and checkpoint.has(stage):
+            logger.info(f"{name}: {stage} already done. Skipping.")
+            return checkpoint.load(stage)
+
+        start, end, _, _ = chunks[i]
+        chunk_audio = audio[start:end]
+        with gpu_pool.acquire() as engine:
+            aligned = engine.align(engine.asr(chunk_audio), chunk_audio)
+        with diarize_pool.acquire() as engine:
+            turns, embeddings = engine.diarize_with_embeddings(chunk_audio)
+        result = engine.assign_speakers(turns, aligned)
+        logger.info(f"{name}: {stage} of {len(chunks)} done")
+
+        done = {'result': result, 'turns': turns, 'embeddings': embeddings}
+        if checkpoint:
+            checkpoint.save(stage, done)
+        return done
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(gpu_pool),
+            thread_name_prefix="chunk") as pool:
+        done = list(pool.map(run_chunk, range(len(chunks))))
+
+    speaker_chunks = []
+    for i, (chunk, (start, _, _, _)) in enumerate(zip(done, chunks)):
+        offset_s = start / sample_rate
+        previous_end = chunks[i - 1][1] if i else start
+        speaker_chunks.append({
+            'turns': [{**t, 'start': t['start'] + offset_s,
+                       'end': t['end'] + offset_s} for t in chunk['turns']],
+            'embeddings': chunk['embeddings'],
+            'overlap': (start / sample_rate, previous_end / sample_rate),
+        })
+    maps = reconcile_speakers(speaker_chunks)
+    logger.info(f"{name}: {len(chunks)} chunks share "
+                f"{len({s for m in maps for s in m.values()})} speakers")
+    return stitch([chunk['result'] for chunk in done], chunks, maps,
+                  sample_rate)
@@ -0,0 +1,159 @@
+#!python
+# Control plane load test against local_api_server.py.
+#
+# Starts the local server with a synthetic backlog and runs many simulated
+# workers against it, each in its own process. A simulated worker uses the
+# real ApiClient, QueuePoller, lease, LeaseHeartbeat and QueueAcker code and
+# uploads a real compact transcript, but sleeps instead of downloading and
+# transcribing, so dozens of them fit on one machine. The server's lease
+# contention, duplicate upload and throughput stats are printed as json.
+#
+#   ./load_test.py --workers 32 --backlog 2000 --latency_ms 150
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import random
+import threading
+import time
+
+from api_client import ApiClient
+from local_api_server import (LocalApi, log_stats, make_server,
+                              make_synthetic_backlog)
+import transcript_codec
+from video_queue import LeaseHeartbeat, QueueAcker, QueuePoller, lease_videos
+
+logger = logging.getLogger(__name__)
+
+
+def load_compact_transcript():
+    with open(transcript_codec.DEFAULT_BENCHMARK_FILE) as f:
+        transcript = json.load(f)
+    return transcript_codec.encode(transcript)
+
+
+def simulate_worker(base_url, worker_id, args, compact):
+    client = ApiClient(base_url,
+                       {'user_id': worker_id, 'auth_code': args.auth_code},
+                       backoff_s=0.1, max_backoff_s=2)
+    acker = QueueAcker(client, args.ack_interval).start()
+    heartbeat = LeaseHeartbeat(client, args.lease_renew_interval).start()
+    poller = QueuePoller(client, args.idle_timeout, args.poll_interval,
+                         args.queue_window)
+
+    done = 0
+    while batch := poller.next_batch(args.lease_batch):
+        by_category = collections.defaultdict(list)
+        for category, video_id in batch:
+            by_category[category].append(video_id)
+
+        for category, video_ids in by_category.items():
+            granted = lease_videos(client, category, video_ids)
+            heartbeat.add(category, granted)
+            for video_id in granted:
+                time.sleep(random.expovariate(1 / args.transcribe_s))
+                response, _ = client.put_gzip_json("transcript", {
+                    'category': category,
+                    'video_id': video_id,
+                    'compact_transcripts': {compact['language']: compact},
+                })
+                if response.status_code != 200:
+                    logger.error(f"{worker_id}: upload of {video_id} "
+                                 f"failed: {response.text}")
+                    heartbeat.release(category, [video_id])
+                    continue
+                acker.ack(category, video_id)
+                heartbeat.done(category, video_id)
+                done += 1
+
+    poller.close()
+    acker.close()
+    heartbeat.close()
+    client.delete("vast", {})
+    logger.info(f"{worker_id}: transcribed {done} videos")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Worker control plane load test.',
+        description=('Runs simulated workers against local_api_server.py '
+                     'and reports lease contention, duplicate work and '
+                     'request throughput'))
+    parser.add_argument('-j', '--workers', dest='workers', type=int,
+                        default=24, help='Number of worker processes')
+    parser.add_argument('-n', '--backlog', dest='backlog', metavar="VIDEOS",
+                        type=int, default=500,
+                        help='Number of synthetic videos to queue')
+    parser.add_argument('--categories', dest='categories', nargs='+',
+                        default=["testcategory"],
+                        help='Categories the backlog is spread over')
+    parser.add_argument('--transcribe_s', dest='transcribe_s', type=float,
+                        default=2,
+                        help='Mean simulated transcription time per video')
+    parser.add_argument('--lease_batch', dest='lease_batch', type=int,
+                        default=4, help='Videos leased per PATCH')
+    parser.add_argument('--ack_interval', dest='ack_interval', type=float,
+                        default=5, help='Seconds between batched deletes')
+    parser.add_argument('--lease_renew_interval',
+                        dest='lease_renew_interval', type=float, default=60,
+                        help='Seconds between lease renewals')
+    parser.add_argument('--idle_timeout', dest='idle_timeout', type=float,
+                        default=10,
+                        help='Seconds a worker waits on an empty queue')
+    parser.add_argument('--poll_interval', dest='poll_interval', type=float,
+                        default=2,
+                        help='Seconds between polls of an empty queue')
+    parser.add_argument('--queue_window', dest='queue_window', type=int,
+                        default=100,
+                        help='Oldest unleased videos a batch is picked from')
+    parser.add_argument('--latency_ms', dest='latency_ms', type=float,
+                        default=50, help='Delay added to every request')
+    parser.add_argument('--latency_jitter_ms', dest='latency_jitter_ms',
+                        type=float, default=25,
+                        help='Random +/- spread of the added delay')
+    parser.add_argument('--error_rate', dest='error_rate', type=float,
+                        default=0.01,
+                        help='Fraction of requests answered with a 503')
+    parser.add_argument('--auth_code', dest='auth_code', default="local",
+                        help='auth_code the server expects')
+    parser.add_argument('-d', '--debug', dest='debug',
+                        help='Enable debug logging',
+                        action=argparse.BooleanOptionalAction)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    api = LocalApi(make_synthetic_backlog(args.backlog, args.categories),
+                   args.auth_code, args.latency_ms, args.latency_jitter_ms,
+                   args.error_rate)
+    server = make_server(api, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://localhost:{server.server_port}"
+
+    compact = load_compact_transcript()
+    start = time.time()
+    workers = [
+        multiprocessing.Process(
+            target=simulate_worker,
+            args=(base_url, f"worker-{i}", args, compact))
+        for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall_s = time.time() - start
+
+    server.shutdown()
+    stats = api.stats()
+    stats['wall_s'] = wall_s
+    stats['videos_per_s'] = stats['videos_uploaded'] / wall_s
+    log_stats(stats)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!python
+# Local stand-in for the Cloud Run endpoints the worker talks to.
+#
+# Implements the video-queue GET/PATCH/DELETE, transcript PUT and vast
+# GET/PATCH/DELETE contract of functions/src/video_queue.ts and
+# transcript.ts, with the same user_id/auth_code check, over a synthetic
+# in-memory backlog. Point workers at it with a base url that has a scheme,
+# which ApiClient routes by path instead of by subdomain:
+#
+#   ./local_api_server.py --backlog 1000 --latency_ms 200 --error_rate 0.02
+#   API_BASE_URL=http://localhost:8080 API_PASSWORD=local ...
+#
+# Latency and 503s are injected before each request is handled. PATCH checks
+# and writes each video under one lock, like the production handler's
+# transaction per video. Lease contention, duplicate transcript uploads and
+# request throughput are served from GET /stats and logged on exit.
+
+import argparse
+import collections
+import copy
+import datetime
+import gzip
+import http.server
+import json
+import logging
+import random
+import string
+import threading
+import time
+import urllib.parse
+
+from runtime_table import RuntimeTable
+import transcript_codec
+
+logger = logging.getLogger(__name__)
+
+LEASE_S = 2 * 60 * 60
+VIDEO_ID_CHARS = string.ascii_letters + string.digits + "-"
+
+
+def make_synthetic_backlog(num_videos, categories):
+    """Returns {category: {video_id: entry}} with `num_videos` new videos."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    queue = {category: {} for category in categories}
+    for i in range(num_videos):
+        video_id = "".join(random.choices(VIDEO_ID_CHARS, k=11))
+        added = now + datetime.timedelta(milliseconds=i)
+        queue[categories[i % len(categories)]][video_id] = {
+            'add': _iso(added), 'lease_expires': "", 'vast_instance': ""}
+    return queue
+
+
+def _iso(ts):
+    # Matches javascript's Date.toISOString().
+    return ts.isoformat(timespec='milliseconds').replace("+00:00", "Z")
+
+
+def _response(ok, message, data=None):
+    return {'ok': ok, 'message': message, 'data': data or {}}
+
+
+class LocalApi:
+    """Queue state and request handling shared by all server threads."""
+
+    def __init__(self, queue, auth_code, latency_ms=0, latency_jitter_ms=0,
+                 error_rate=0):
+        self.queue = queue
+        self._auth_code = auth_code
+        self._latency_ms = latency_ms
+        self._latency_jitter_ms = latency_jitter_ms
+        self._error_rate = error_rate
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.latencies = collections.defaultdict(list)
+        self.leases = collections.Counter()
+        self.uploads = collections.Counter()
+        self.upload_bytes = collections.Counter()
+        self.removed_instances = []
+        self.runtime_table = RuntimeTable()
+
+    def handle(self, method, endpoint, query, headers, body):
+        """Returns (status, response json) for one request."""
+        self._inject_latency()
+        if random.random() < self._error_rate:
+            # What Cloud Run sends when it has no instance to route to.
+            return 503, _response(False, "Injected error")
+
+        route = {
+            ("GET", "video-queue"): self._get_queue,
+            ("PATCH", "video-queue"): self._update_entries,
+            ("DELETE", "video-queue"): self._remove_items,
+            ("PUT", "transcript"): self._upload_transcript,
+            ("GET", "vast"): self._get_runtime_table,
+            ("PATCH", "vast"): self._add_runtime_rows,
+            ("DELETE", "vast"): self._remove_vast_instance,
+        }.get((method, endpoint))
+        if not route:
+            return 405, _response(False, "Method Not Allowed")
+
+        params = query if method == "GET" else body
+        if not isinstance(params, dict) or 'user_id' not in params:
+            return 401, _response(False, "Expects user_id and auth_code")
+        if params.get('auth_code') != self._auth_code:
+            return 401, _response(False, "invalid auth_code")
+        return route(params, headers)
+
+    def record(self, key, status, latency_s, raw_bytes, wire_bytes):
+        with self._lock:
+            self.requests[key] += 1
+            self.statuses[f"{key} {status}"] += 1
+            self.latencies[key].append(latency_s)
+            if key == "PUT transcript" and status == 200:
+                self.upload_bytes['raw'] += raw_bytes
+                self.upload_bytes['wire'] += wire_bytes
+
+    def stats(self):
+        with self._lock:
+            elapsed_s = time.time() - self._start
+            remaining = sum(len(v) for v in self.queue.values())
+            duplicates = {f"{category}/{video_id}": count
+                          for (category, video_id), count
+                          in self.uploads.items() if count > 1}
+            return {
+                'elapsed_s': elapsed_s,
+                'queue_remaining': remaining,
+                'requests': dict(self.requests),
+                'requests_per_s': sum(self.requests.values()) / elapsed_s,
+                'statuses': dict(self.statuses),
+                'latency_p50_s': {
+                    key: sorted(values)[len(values) // 2]
+                    for key, values in self.latencies.items()},
+                'leases': dict(self.leases),
+                'videos_uploaded': len(self.uploads),
+                'duplicate_uploads': sum(duplicates.values()) - len(
+                    duplicates),
+                'duplicate_videos': duplicates,
+                'upload_bytes': dict(self.upload_bytes),
+                'removed_instances': list(self.removed_instances),
+            }
+
+    def _inject_latency(self):
+        delay_ms = self._latency_ms + random.uniform(
+            -self._latency_jitter_ms, self._latency_jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def _get_queue(self, params, headers):
+        with self._lock:
+            new_vids = copy.deepcopy(self.queue)
+        return 200, _response(True, "New vids", new_vids)
+
+    def _update_entries(self, params, headers):
+        category = params.get('category')
+        if category not in self.queue:
+            return 400, _response(False, "Expects category")
+
+        user_id = params['user_id']
+        now = _iso(datetime.datetime.now(datetime.timezone.utc))
+        lease_expires = _iso(datetime.datetime.now(datetime.timezone.utc) +
+                             datetime.timedelta(seconds=LEASE_S))
+        updated_ids = []
+        leased_ids = []
+        with self._lock:
+            # Each video is checked and written atomically, like the
+            # transaction per video of the production handler.
+            for video_id in params.get('video_ids', []):
+                entry = self.queue[category].get(video_id)
+                if entry is None:
+                    continue
+                owned = entry['vast_instance'] == user_id
+                if entry['lease_expires'] > now and not owned:
+                    leased_ids.append(video_id)
+                    continue
+
+                if params.get('release'):
+                    if owned:
+                        updated_ids.append(video_id)
+                        self.leases['released'] += 1
+                        self.queue[category][video_id] = {
+                            **entry, 'vast_instance': "", 'lease_expires': ""}
+                    continue
+
+                updated_ids.append(video_id)
+                self.leases['renewed' if owned else 'granted'] += 1
+                self.queue[category][video_id] = {
+                    **entry, 'vast_instance': user_id,
+                    'lease_expires': lease_expires}
+            self.leases['refused'] += len(leased_ids)
+
+        if not updated_ids and leased_ids:
+            return 403, _response(False,
+                                  f"{', '.join(leased_ids)} already leased")
+        return 200, _response(True, "Items updated",
+                              {'updated_ids': updated_ids,
+                               'leased_ids': leased_ids})
+
+    def _remove_items(self, params, headers):
+        category = params.get('category')
+        if category not in self.queue:
+            return 400, _response(False, "Expects category")
+        with self._lock:
+            for video_id in params.get('video_ids', []):
+                self.queue[category].pop(video_id, None)
+        return 200, _response(True, "Items removed")
+
+    def _upload_transcript(self, params, headers):
+        if headers.get('Content-Type') != "application/json":
+            return 400, _response(False, "Expects JSON")
+        category = params.get('category')
+        video_id = params.get('video_id')
+        transcripts = params.get('transcripts') or {}
+        compact_transcripts = params.get('compact_transcripts') or {}
+        if not category or not video_id or not (
+                transcripts or compact_transcripts):
+            return 400, _response(
+                False, "Expects category, video_id and transcripts or "
+                       "compact_transcripts")
+
+        try:
+            for compact in compact_transcripts.values():
+                transcript_codec.decode(compact)
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            return 400, _response(False, f"Bad compact transcript: {e}")
+
+        with self._lock:
+            self.uploads[(category, video_id)] += 1
+        return 200, _response(True, "update done")
+
+    def _get_runtime_table(self, params, headers):
+        with self._lock:
+            return 200, _response(True, "Runtime table",
+                                  self.runtime_table.rows)
+
+    def _add_runtime_rows(self, params, headers):
+        rows = params.get('runtime_table')
+        if not isinstance(rows, dict):
+            return 400, _response(False, "Expects runtime_table rows")
+        with self._lock:
+            self.runtime_table.merge(rows)
+        return 200, _response(True, "Runtime table updated")
+
+    def _remove_vast_instance(self, params, headers):
+        with self._lock:
+            self.removed_instances.append(params['user_id'])
+        return 200, _response(True, "Instance removed")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so the worker's pooled session is exercised.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _handle(self, method):
+        api = self.server.api
+        start = time.time()
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.strip("/")
+
+        raw = self._read_body()
+        if endpoint == "stats" and method == "GET":
+            self._send(200, api.stats())
+            return
+
+        wire_bytes = len(raw)
+        if self.headers.get('Content-Encoding') == "gzip":
+            raw = gzip.decompress(raw)
+        try:
+            body = json.loads(raw) if raw else {}
+        except json.JSONDecodeError:
+            self._send(400, _response(False, "Invalid json"))
+            return
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+
+        status, response = api.handle(method, endpoint, query, self.headers,
+                                      body)
+        self._send(status, response)
+        api.record(f"{method} {endpoint}", status, time.time() - start,
+                   len(raw), wire_bytes)
+
+    def _read_body(self):
+        # requests sends streamed bodies with chunked transfer encoding.
+        if self.headers.get('Transfer-Encoding') == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b""):
+                        pass
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(api, host="localhost", port=8080):
+    """Returns a threading http server for `api`. Port 0 picks a free one."""
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.api = api
+    return server
+
+
+def log_stats(stats):
+    for key, value in stats.items():
+        if key != 'duplicate_videos':
+            logger.info(f"{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Local API server.',
+        description=('Stand-in for the video-queue, transcript and vast '
+                     'endpoints for load testing workers'))
+    parser.add_argument('--host', dest='host', default="localhost",
+                        help='Interface to listen on')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--auth_code', dest='auth_code', default="local",
+                        help=('auth_code every user_id must send. Workers '
+                              'read it from API_PASSWORD'))
+    parser.add_argument('-n', '--backlog', dest='backlog', metavar="VIDEOS",
+                        type=int, default=100,
+                        help='Number of synthetic videos to queue')
+    parser.add_argument('--categories', dest='categories', nargs='+',
+                        default=["testcategory"],
+                        help='Categories the backlog is spread over')
+    parser.add_argument('--latency_ms', dest='latency_ms', type=float,
+                        default=0, help='Delay added to every request')
+    parser.add_argument('--latency_jitter_ms', dest='latency_jitter_ms',
+                        type=float, default=0,
+                        help='Random +/- spread of the added delay')
+    parser.add_argument('--error_rate', dest='error_rate', type=float,
+                        default=0,
+                        help='Fraction of requests answered with a 503')
+    parser.add_argument('-d', '--debug', dest='debug',
+                        help='Log every request',
+                        action=argparse.BooleanOptionalAction)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    api = LocalApi(make_synthetic_backlog(args.backlog, args.categories),
+                   args.auth_code, args.latency_ms, args.latency_jitter_ms,
+                   args.error_rate)
+    server = make_server(api, args.host, args.port)
+    logger.info(f"Serving {args.backlog} videos on "
+                f"http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log_stats(api.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# Per-video performance records.
+#
+# Every processed video appends one json line to the metrics file with its
+# download size and time, audio duration, wall and CPU time of each stage,
+# peak memory and the facts about the machine it ran on. The records are
+# what tell us which stage to optimize next and which vast.ai hosts are
+# actually fast. A summary is logged when the worker exits.
+
+import datetime
+import json
+import logging
+import os
+import resource
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Sampling period of the peak memory sampler.
+_SAMPLE_S = 0.5
+
+
+def _import_torch():
+    try:
+        import torch
+        return torch
+    except ImportError:
+        return None
+
+
+def machine_info(args):
+    """Facts about this machine and configuration to tag records with."""
+    info = {
+        'host': os.uname().nodename,
+        'container_id': os.environ.get('CONTAINER_ID'),
+        'cores': os.cpu_count(),
+        'model': args.model,
+        'compute_type': args.compute_type,
+        'batch_size': args.batch_size,
+        'threads': args.threads,
+        'engine': args.engine,
+        'devices': args.devices,
+        'gpu_count': 0,
+        'gpu_model': None,
+        'gpu_total_bytes': None,
+    }
+
+    torch = _import_torch()
+    if torch and torch.cuda.is_available():
+        props = torch.cuda.get_device_properties(0)
+        info['gpu_count'] = torch.cuda.device_count()
+        info['gpu_model'] = props.name
+        info['gpu_total_bytes'] = props.total_memory
+    return info
+
+
+def current_rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def current_rss_anon_bytes():
+    # RSS counts the pages of memory mapped audio, which the kernel can
+    # drop under pressure. Anonymous memory is what pushes a box into swap.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def children_peak_rss_bytes():
+    # ru_maxrss is in KiB on Linux. Covers the whisperx CLI subprocess.
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class PeakMemorySampler:
+    """Tracks peak RSS and GPU memory while each video is in flight.
+
+    Videos overlap in the pipeline, so a video's peak is the process peak
+    seen between start() and stop() for it, not memory it alone used.
+    """
+
+    def __init__(self):
+        torch = _import_torch()
+        self._cuda = torch.cuda if torch and torch.cuda.is_available() \
+            else None
+        self._lock = threading.Lock()
+        self._active = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="memory-sampler", daemon=True)
+
+    def start_sampler(self):
+        self._thread.start()
+        return self
+
+    def start(self, name):
+        with self._lock:
+            self._active[name] = {'peak_rss_bytes': 0,
+                                  'peak_rss_anon_bytes': None,
+                                  'peak_gpu_bytes': None}
+        self._sample()
+
+    def stop(self, name):
+        self._sample()
+        with self._lock:
+            return self._active.pop(name, {})
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        rss_anon = current_rss_anon_bytes()
+        gpu = None
+        if self._cuda:
+            gpu = sum(self._cuda.memory_reserved(i)
+                      for i in range(self._cuda.device_count()))
+        with self._lock:
+            for peaks in self._active.values():
+                peaks['peak_rss_bytes'] = max(peaks['peak_rss_bytes'], rss)
+                if rss_anon is not None:
+                    peaks['peak_rss_anon_bytes'] = max(
+                        peaks['peak_rss_anon_bytes'] or 0, rss_anon)
+                if gpu is not None:
+                    peaks['peak_gpu_bytes'] = max(
+                        peaks['peak_gpu_bytes'] or 0, gpu)
+
+    def _run(self):
+        while not self._stop.wait(_SAMPLE_S):
+            self._sample()
+
+
+class MetricsRecorder:
+    """Appends one json record per video to `path`."""
+
+    def __init__(self, path, machine):
+        self._path = path
+        self._machine = machine
+        self._lock = threading.Lock()
+        self._records = []
+        self.sampler = PeakMemorySampler().start_sampler()
+
+    def record(self, **fields):
+        record = {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **fields,
+            'children_peak_rss_bytes': children_peak_rss_bytes(),
+            'machine': self._machine,
+        }
+        with self._lock:
+            self._records.append(record)
+            with open(self._path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+    def close(self):
+        self.sampler.close()
+        self.log_summary()
+
+    def log_summary(self):
+        with self._lock:
+            records = list(self._records)
+        ok = [r for r in records if r.get('ok')]
+        logger.info(f"Metrics: {len(ok)} videos done, "
+                    f"{len(records) - len(ok)} failed. "
+                    f"Records in {self._path}")
+        if not ok:
+            return
+
+        audio_s = sum(r.get('audio_s') or 0 for r in ok)
+        total_s = sum(r.get('total_s') or 0 for r in ok)
+        download_bytes = sum(r.get('download_bytes') or 0 for r in ok)
+        download_s = sum(r.get('download_s') or 0 for r in ok)
+        trimmed_s = sum(r.get('trimmed_s') or 0 for r in ok)
+        logger.info(
+            f"Metrics: {audio_s / 3600:.2f} hours of audio in "
+            f"{total_s / 3600:.2f} hours of pipeline time "
+            f"(real time factor {total_s / audio_s if audio_s else 0:.3f}). "
+            f"Downloaded {download_bytes} bytes at "
+            f"{download_bytes / download_s if download_s else 0:.0f} B/s. "
+            f"Trimmed {trimmed_s / 3600:.2f} hours of non-speech")
+
+        stage_wall = {}
+        for r in ok:
+            for name, stage in r.get('stages', {}).items():
+                stage_wall[name] = stage_wall.get(name, 0) + stage['wall_s']
+        for name, wall_s in stage_wall.items():
+            logger.info(f"Metrics: {name} {wall_s:.1f}s total, real time "
+                        f"factor {wall_s / audio_s if audio_s else 0:.4f}")
+
+        logger.info(
+            "Metrics: peak RSS "
+            f"{max(r.get('peak_rss_bytes') or 0 for r in ok)} bytes "
+            f"({max(r.get('peak_rss_anon_bytes') or 0 for r in ok)} "
+            "anonymous), peak GPU "
+            f"{max(r.get('peak_gpu_bytes') or 0 for r in ok)} bytes")
@@ -5,5 +5,15 @@ export PATH=${HOME}/.local/share/fnm:$PATH
 eval "$(fnm env --use-on-cd --shell bash)"
 fnm use lts/latest
 
-# Default to giving 10 mins on failure.
-/workspace/app/lysine_protocol.sh "${3-:30}" & python /workspace/app/transcribe_worker.py -w /tmp/transcribe -t "${1:-4}" -x "$2" -m large-v3 -c -s; /workspace/app/lysine_protocol.sh "${4:-10}"
+# The worker stops taking videos that cannot finish before lysine fires and
+# exits once it is out of time.
+DEADLINE=$(( $(date +%s) + ${3:-30} * 60 ))
+/workspace/app/lysine_protocol.sh "${3:-30}" &
+
+# Destroy the instance as soon as the worker finishes cleanly. Default to
+# giving 10 mins on failure.
+if python /workspace/app/transcribe_worker.py -w /tmp/transcribe -t "${1:-4}" -x "$2" -m large-v3 -c --time_budget "${3:-30}" --deadline "${DEADLINE}"; then
+  /workspace/app/lysine_protocol.sh 0
+else
+  /workspace/app/lysine_protocol.sh "${4:-10}"
+fi
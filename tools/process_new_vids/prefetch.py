@@ -0,0 +1,230 @@
+# Background lease + download of upcoming videos.
+#
+# Downloading audio leaves the GPU idle, so AudioPrefetcher leases and
+# downloads the next few videos in a background thread while the current
+# one is transcribed. Lookahead is bounded both by a count and by disk: the
+# instance only has DISK_GB (see functions-python/main.py) and a prefetch
+# must never starve the running transcription of space.
+#
+# Each leased batch is resolved first so its durations are known, then
+# taken longest first. A long meeting started last would keep the instance
+# running long after its peers, so it goes first while there is the most
+# time left, and videos that cannot finish in time are handed back.
+
+import dataclasses
+import logging
+import pathlib
+import queue
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# How often blocked producers recheck the stop flag and disk usage.
+_POLL_S = 30
+
+
+@dataclasses.dataclass
+class PrefetchedVideo:
+    category: str
+    video_id: str
+    video: object
+    audio_path: pathlib.Path
+    # Disk reserved for the video, which includes any decoded audio.
+    num_bytes: int
+    download_s: float
+    # Size of the stream as served, or None if unknown.
+    download_bytes: int = None
+
+
+class AudioPrefetcher:
+    """Iterates over leased and downloaded videos.
+
+    `next_batch_fn(n)` returns up to n (category, video_id) candidates, or
+    None once there is no more work. Each batch is leased together.
+    `lease_fn(category, video_ids)` returns the video ids granted.
+    `resolve_fn(video_id)` returns (video, stream, expected_num_bytes),
+    where expected_num_bytes is the disk the video will need and
+    `stream.filesize`, if any, is the size of the download.
+    `admit_fn(category, video_id, duration_s)` returns whether to take on a
+    resolved video. `duration_s` comes from `video.length` and may be None.
+    `download_fn(video_id, stream)` downloads and returns the audio path.
+    `on_skip_fn(category, video_id)` is called for leased videos that could
+    not be downloaded or were not admitted.
+
+    Each yielded PrefetchedVideo must be handed back to release() once it
+    is no longer needed so its disk reservation is returned. Released audio
+    is passed to `discard_fn(item)` which by default deletes the file.
+    """
+
+    def __init__(self, next_batch_fn, lease_fn, resolve_fn, download_fn,
+                 workdir, lookahead=2, disk_budget_bytes=25 * GB,
+                 disk_reserve_bytes=5 * GB, discard_fn=None, lease_batch=1,
+                 on_skip_fn=None, admit_fn=None):
+        self._next_batch_fn = next_batch_fn
+        self._lease_fn = lease_fn
+        self._lease_batch = max(1, lease_batch)
+        self._on_skip_fn = on_skip_fn or (lambda category, video_id: None)
+        self._admit_fn = admit_fn or (
+            lambda category, video_id, duration_s: True)
+        self._resolve_fn = resolve_fn
+        self._download_fn = download_fn
+        self._discard_fn = discard_fn or (
+            lambda item: item.audio_path.unlink(missing_ok=True))
+        self._workdir = workdir
+        self._disk_budget_bytes = disk_budget_bytes
+        self._disk_reserve_bytes = disk_reserve_bytes
+
+        self._ready = queue.Queue(maxsize=max(1, lookahead))
+        self._cv = threading.Condition()
+        self._held_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="prefetch", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def __iter__(self):
+        while True:
+            item = self._ready.get()
+            if item is None:
+                return
+            yield item
+
+    def release(self, item):
+        try:
+            self._discard_fn(item)
+        finally:
+            self._unreserve(item.num_bytes)
+
+    def close(self):
+        self._stop.set()
+        with self._cv:
+            self._cv.notify_all()
+
+        # Unblock a producer waiting on a full queue and return whatever
+        # it had already downloaded.
+        while self._thread.is_alive() or not self._ready.empty():
+            try:
+                item = self._ready.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is not None:
+                self.release(item)
+        self._thread.join()
+
+    def _has_room(self, num_bytes):
+        # Always allow progress when nothing is held, otherwise a single
+        # large video could block forever.
+        if self._held_bytes == 0:
+            return True
+        if self._held_bytes + num_bytes > self._disk_budget_bytes:
+            return False
+        free = shutil.disk_usage(self._workdir).free
+        return free - num_bytes >= self._disk_reserve_bytes
+
+    def _reserve(self, video_id, num_bytes):
+        with self._cv:
+            while not self._stop.is_set() and not self._has_room(num_bytes):
+                logger.info(f"Prefetch of {video_id} waiting for "
+                            f"{num_bytes} bytes of disk. "
+                            f"{self._held_bytes} bytes held.")
+                self._cv.wait(timeout=_POLL_S)
+            if self._stop.is_set():
+                return False
+            self._held_bytes += num_bytes
+            return True
+
+    def _unreserve(self, num_bytes):
+        with self._cv:
+            self._held_bytes -= num_bytes
+            self._cv.notify_all()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=_POLL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _leased_videos(self):
+        while not self._stop.is_set():
+            batch = self._next_batch_fn(self._lease_batch)
+            if batch is None:
+                return
+
+            by_category = {}
+            for category, video_id in batch:
+                by_category.setdefault(category, []).append(video_id)
+
+            granted = set()
+            for category, video_ids in by_category.items():
+                try:
+                    granted.update((category, video_id) for video_id
+                                   in self._lease_fn(category, video_ids))
+                except Exception:
+                    logger.exception(f"Leasing {category} {video_ids} failed")
+
+            resolved = []
+            for category, video_id in batch:
+                if (category, video_id) not in granted:
+                    continue
+                try:
+                    resolved.append((category, video_id,
+                                     *self._resolve_fn(video_id)))
+                except Exception:
+                    logger.exception(f"Resolving {video_id} failed")
+                    self._on_skip_fn(category, video_id)
+
+            # Longest first. Unknown durations go last.
+            resolved.sort(key=lambda r: getattr(r[2], 'length', None) or 0,
+                          reverse=True)
+            for category, video_id, video, stream, num_bytes in resolved:
+                if self._stop.is_set():
+                    return
+                if not self._admit_fn(category, video_id,
+                                      getattr(video, 'length', None)):
+                    self._on_skip_fn(category, video_id)
+                    continue
+                yield category, video_id, video, stream, num_bytes
+
+    def _run(self):
+        try:
+            for (category, video_id, video, stream,
+                 num_bytes) in self._leased_videos():
+                if self._stop.is_set():
+                    break
+
+                try:
+                    if not self._reserve(video_id, num_bytes):
+                        break
+
+                    start = time.time()
+                    try:
+                        audio_path = self._download_fn(video_id, stream)
+                        download_s = time.time() - start
+                    except Exception:
+                        self._unreserve(num_bytes)
+                        raise
+                except Exception:
+                    logger.exception(f"Prefetch failed for {video_id}")
+                    self._on_skip_fn(category, video_id)
+                    continue
+
+                item = PrefetchedVideo(
+                    category, video_id, video, audio_path, num_bytes,
+                    download_s, getattr(stream, 'filesize', None))
+                logger.info(f"Prefetched {category} {video_id} "
+                            f"({num_bytes} bytes)")
+                if not self._put(item):
+                    self.release(item)
+                    break
+        finally:
+            self._put(None)
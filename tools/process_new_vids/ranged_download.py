@@ -0,0 +1,198 @@
+# Parallel byte range download of a resolved audio stream.
+#
+# pytubefix's stream.download() fetches the file over one sequential
+# connection, and YouTube throttles each connection, so a multi-hour
+# meeting's audio takes minutes on a cheap host. A dropped connection also
+# starts it over. RangedDownloader fetches the stream url in fixed size byte
+# ranges over several connections and writes each one in place into a file
+# preallocated to the full length.
+#
+# Finished ranges are appended to a .ranges file next to the download. A
+# retry of a range resumes from the last byte written, and a later download
+# to the same path only fetches the ranges that never finished. The file is
+# only returned once every range is written and its size matches the
+# stream's length.
+#
+# iter_bytes() fetches ranges the same way but yields them in order for a
+# consumer like stream_decode.py, holding a bounded window of ranges in
+# memory.
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+PROGRESS_SUFFIX = ".ranges"
+
+# Read size of each response body.
+_READ_BYTES = 256 * 1024
+
+# Sent by pytubefix too. googlevideo rejects some requests without them.
+_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "accept-language": "en-US,en",
+}
+
+
+class RangedDownloadError(Exception):
+    pass
+
+
+def progress_path(dest):
+    """Returns the file recording the finished ranges of `dest`."""
+    return dest.with_name(dest.name + PROGRESS_SUFFIX)
+
+
+class RangedDownloader:
+    def __init__(self, connections=4, range_bytes=8 * MB, max_attempts=5,
+                 timeout_s=30):
+        self._connections = max(1, connections)
+        self._range_bytes = range_bytes
+        self._max_attempts = max_attempts
+        self._timeout_s = timeout_s
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self._connections)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def download(self, url, dest, total_bytes):
+        """Writes the `total_bytes` long resource at `url` to `dest`.
+
+        Resumes ranges already recorded for `dest` by an earlier call.
+        Raises RangedDownloadError if the server does not honor ranges or
+        a range keeps failing.
+        """
+        if not total_bytes:
+            raise RangedDownloadError(f"Unknown length for {dest.name}")
+
+        progress = progress_path(dest)
+        ranges = self._ranges(total_bytes)
+        done = self._load_progress(dest, progress, total_bytes)
+        todo = [r for r in ranges if r[0] not in done]
+        if len(todo) < len(ranges):
+            logger.info(f"Resuming {dest.name} with {len(todo)} of "
+                        f"{len(ranges)} ranges left")
+
+        with open(dest, "r+b" if done else "w+b") as f:
+            f.truncate(total_bytes)
+            progress_lock = threading.Lock()
+            with open(progress, "a") as progress_file:
+                def write(block, pos):
+                    os.pwrite(f.fileno(), block, pos)
+
+                def fetch(byte_range):
+                    self._fetch_range(url, write, *byte_range, total_bytes)
+                    with progress_lock:
+                        progress_file.write(f"{byte_range[0]}\n")
+                        progress_file.flush()
+
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self._connections,
+                        thread_name_prefix="range") as pool:
+                    for future in concurrent.futures.as_completed(
+                            [pool.submit(fetch, r) for r in todo]):
+                        future.result()
+
+        num_bytes = dest.stat().st_size
+        if num_bytes != total_bytes:
+            raise RangedDownloadError(f"{dest.name} is {num_bytes} bytes, "
+                                      f"expected {total_bytes}")
+        progress.unlink(missing_ok=True)
+        return dest
+
+    def iter_bytes(self, url, total_bytes):
+        """Yields the `total_bytes` long resource at `url` in order.
+
+        Up to twice as many ranges as connections are fetched ahead.
+        """
+        if not total_bytes:
+            raise RangedDownloadError(f"Unknown length for {url}")
+
+        def fetch(start, end):
+            buffer = bytearray(end - start)
+
+            def write(block, pos):
+                buffer[pos - start:pos - start + len(block)] = block
+
+            self._fetch_range(url, write, start, end, total_bytes)
+            return buffer
+
+        ranges = iter(self._ranges(total_bytes))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._connections,
+                thread_name_prefix="range") as pool:
+            window = collections.deque(
+                pool.submit(fetch, *r)
+                for r in itertools.islice(ranges, 2 * self._connections))
+            try:
+                while window:
+                    buffer = window.popleft().result()
+                    for r in itertools.islice(ranges, 1):
+                        window.append(pool.submit(fetch, *r))
+                    yield buffer
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def _ranges(self, total_bytes):
+        return [(start, min(start + self._range_bytes, total_bytes))
+                for start in range(0, total_bytes, self._range_bytes)]
+
+    @staticmethod
+    def _load_progress(dest, progress, total_bytes):
+        if not (dest.exists() and progress.exists()):
+            return set()
+        if dest.stat().st_size != total_bytes:
+            return set()
+        with open(progress) as f:
+            # A torn last line from a crash is ignored.
+            return {int(line) for line in f if line.strip().isdigit()}
+
+    def _fetch_range(self, url, write, start, end, total_bytes):
+        # [start, end) with `pos` the next byte to write(block, pos).
+        pos = start
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                with self._session.get(
+                        url, headers={**_HEADERS,
+                                      "Range": f"bytes={pos}-{end - 1}"},
+                        stream=True, timeout=self._timeout_s) as response:
+                    if response.status_code >= 500:
+                        response.raise_for_status()
+                    if response.status_code != 206:
+                        # A 200 would be the whole file from byte 0.
+                        raise RangedDownloadError(
+                            f"Range request got HTTP {response.status_code}")
+                    content_range = response.headers.get("Content-Range", "")
+                    if content_range.rpartition("/")[2] != str(total_bytes):
+                        raise RangedDownloadError(
+                            f"Content-Range {content_range!r} does not match "
+                            f"{total_bytes} bytes")
+                    for block in response.iter_content(_READ_BYTES):
+                        block = block[:end - pos]
+                        write(block, pos)
+                        pos += len(block)
+                if pos == end:
+                    return
+                raise requests.ConnectionError(
+                    f"Range ended at {pos} of [{start}, {end})")
+            except requests.RequestException as e:
+                if attempt == self._max_attempts:
+                    raise RangedDownloadError(
+                        f"Range [{start}, {end}) failed {attempt} times"
+                    ) from e
+                logger.info(f"Retrying range [{start}, {end}) from {pos}: "
+                            f"{e}")
+                time.sleep(attempt)
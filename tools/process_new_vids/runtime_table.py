@@ -0,0 +1,162 @@
+# Learned processing time of a video per machine profile.
+#
+# The scheduler's MINS_PER_VID and the worker's --expected_rtf are guesses.
+# RuntimeTable learns from the per-video metrics instead. A machine profile
+# is the number and model of GPUs, the compute type autotune picked and the
+# CPU core count rounded down to a power of two. For each profile the table
+# keeps running sums from which a least squares line of processing seconds
+# against minutes of audio is fitted, so a row stays a handful of numbers
+# however many videos it has seen and rows from different workers merge by
+# adding. Processing seconds are the pipeline time charged to a video by
+# budget.CompletionClock, not its start to finish time, so n videos take
+# about n times the mean on one machine however much they overlap.
+#
+# The shared table lives in the RTDB under _admin/runtime_table. Workers
+# read it at startup through the vast endpoint and add the rows for the
+# videos they processed when they exit. functions-python/main.py reads it
+# directly to size lysine timeouts and instance counts. A profile with too
+# few videos borrows from rows for the same GPU, then from every row.
+
+import json
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+# Videos needed before a set of rows is trusted.
+MIN_VIDEOS = 3
+
+# RTDB keys cannot contain . $ # [ ] or /.
+_KEY_UNSAFE = re.compile(r"[.$#\[\]/|]+")
+
+
+def normalize_gpu(name):
+    """Maps torch's and vast.ai's names for a GPU to the same string.
+
+    torch says "NVIDIA GeForce RTX 3090" where vast.ai says "RTX 3090".
+    """
+    if not name:
+        return "cpu"
+    name = re.sub(r"\b(NVIDIA|GeForce)\b", "", name)
+    return _KEY_UNSAFE.sub("_", " ".join(name.split())).replace(" ", "_")
+
+
+def cores_bucket(cores):
+    return 2 ** int(math.log2(cores)) if cores and cores >= 1 else 0
+
+
+def profile_key(gpu_model, compute_type, cores, num_gpus=1):
+    gpu = normalize_gpu(gpu_model)
+    if num_gpus and num_gpus > 1:
+        gpu = f"{num_gpus}x{gpu}"
+    return "|".join([gpu,
+                     _KEY_UNSAFE.sub("_", compute_type or "default"),
+                     str(cores_bucket(cores))])
+
+
+def _empty_row():
+    # x is minutes of audio and y processing seconds.
+    return {'n': 0, 'x': 0.0, 'y': 0.0, 'xx': 0.0, 'xy': 0.0, 'stage_s': {}}
+
+
+def add_rows(a, b):
+    """Returns the sum of two rows."""
+    stage_s = dict(a.get('stage_s', {}))
+    for name, seconds in b.get('stage_s', {}).items():
+        stage_s[name] = stage_s.get(name, 0) + seconds
+    return {**{field: a.get(field, 0) + b.get(field, 0)
+               for field in ('n', 'x', 'y', 'xx', 'xy')},
+            'stage_s': stage_s}
+
+
+def fetch_rows(client):
+    """Returns the shared table's rows from the vast endpoint."""
+    response = client.get("vast")
+    if response.status_code != 200:
+        raise Exception(response.text)
+    return response.json()['data'] or {}
+
+
+def upload_rows(client, rows):
+    """Adds `rows` to the shared table."""
+    # Not idempotent. A repeated call would count the videos twice.
+    response = client.patch("vast", {'runtime_table': rows})
+    if response.status_code != 200:
+        raise Exception(response.text)
+
+
+def fit(row):
+    """Returns (overhead_s, seconds per minute of audio) for a row."""
+    n, x, y = row['n'], row['x'], row['y']
+    var = n * row['xx'] - x * x
+    # Videos of nearly the same length say nothing about the intercept.
+    if var <= 1e-6 * max(1, n * row['xx']):
+        return 0.0, (y / x if x else 0.0)
+    slope = (n * row['xy'] - x * y) / var
+    intercept = (y - slope * x) / n
+    if slope < 0 or intercept < 0:
+        # Too few or too noisy videos. A rate alone is the safer guess.
+        return 0.0, (y / x if x else 0.0)
+    return intercept, slope
+
+
+class RuntimeTable:
+    def __init__(self, rows=None):
+        self.rows = {key: add_rows(_empty_row(), row)
+                     for key, row in (rows or {}).items()}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.rows, f)
+
+    def add(self, key, audio_s, total_s, stages=None):
+        """Records one processed video."""
+        x = audio_s / 60
+        self.rows[key] = add_rows(self.rows.get(key, _empty_row()), {
+            'n': 1, 'x': x, 'y': total_s, 'xx': x * x, 'xy': x * total_s,
+            'stage_s': {name: stage['wall_s']
+                        for name, stage in (stages or {}).items()}})
+
+    def merge(self, rows):
+        for key, row in rows.items():
+            self.rows[key] = add_rows(self.rows.get(key, _empty_row()), row)
+
+    def _pooled(self, key):
+        gpu, _, cores = key.split("|")
+        for match in (lambda k: k == key,
+                      lambda k: k.startswith(f"{gpu}|") and
+                      k.endswith(f"|{cores}"),
+                      lambda k: k.startswith(f"{gpu}|"),
+                      lambda k: True):
+            pooled = _empty_row()
+            for k, row in self.rows.items():
+                if match(k):
+                    pooled = add_rows(pooled, row)
+            if pooled['n'] >= MIN_VIDEOS:
+                return pooled
+        return None
+
+    def coefficients(self, key):
+        """Returns (overhead_s, seconds per second of audio) or None."""
+        row = self._pooled(key)
+        if row is None:
+            return None
+        overhead_s, s_per_min = fit(row)
+        return overhead_s, s_per_min / 60
+
+    def predict_s(self, key, audio_s):
+        """Expected seconds to process `audio_s` of audio, or None."""
+        coefficients = self.coefficients(key)
+        if coefficients is None:
+            return None
+        overhead_s, rtf = coefficients
+        return overhead_s + rtf * audio_s
@@ -0,0 +1,158 @@
+# Resource aware pipeline executor.
+#
+# Each video goes through a fixed list of stages (decode, ASR, align,
+# diarize, ...). ASR and alignment are GPU bound while diarization's
+# clustering is CPU bound, so running one video end to end leaves one of
+# the two idle. StageExecutor gives each resource its own pool of threads
+# and moves a job to the next stage's pool when a stage finishes. While
+# video N diarizes on the CPU, video N+1 can be in ASR on the GPU.
+#
+# Threads are enough because the heavy lifting happens in torch, ctranslate2
+# and ffmpeg which all release the GIL.
+
+import concurrent.futures
+import contextlib
+import dataclasses
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+GPU = "gpu"
+CPU = "cpu"
+IO = "io"
+
+# ffmpeg decodes and uploads mostly wait on other processes or the network
+# so two can overlap with everything else.
+DEFAULT_SLOTS = {GPU: 1, CPU: 1, IO: 2}
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    resource: str
+    fn: object  # Called as fn(job). Stores its results in job.state.
+    when: object = None  # If set, the stage only runs when when(job) is true.
+
+
+@dataclasses.dataclass
+class PipelineJob:
+    name: str
+    item: object
+    state: dict = dataclasses.field(default_factory=dict)
+    # time.time() when the job entered its first stage.
+    start_time: float = None
+    # Stage name to its wall_s, thread_cpu_s and process_cpu_s.
+    stage_metrics: dict = dataclasses.field(default_factory=dict)
+
+
+class ReplicaPool:
+    """Lends out interchangeable model replicas, one borrower at a time each.
+
+    With one replica per GPU, a stage borrows whichever GPU is free.
+    """
+
+    def __init__(self, replicas):
+        self.replicas = list(replicas)
+        self._free = queue.Queue()
+        for replica in self.replicas:
+            self._free.put(replica)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        replica = self._free.get()
+        try:
+            yield replica
+        finally:
+            self._free.put(replica)
+
+
+class StageExecutor:
+    """Runs every submitted job through `stages` in order.
+
+    At most `max_in_flight` jobs are in the pipeline at once which bounds
+    memory since each job holds its decoded audio. submit() blocks until
+    there is room. `on_done(job, error)` is called once per job with the
+    exception that stopped it, or None if every stage succeeded. It may
+    return a new job to retry with, which takes over the finished job's
+    place in the pipeline instead of waiting in submit().
+    """
+
+    def __init__(self, stages, on_done, slots=None, max_in_flight=2):
+        self._stages = list(stages)
+        self._on_done = on_done
+        self._max_in_flight = max(1, max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(self._max_in_flight)
+
+        slots = {**DEFAULT_SLOTS, **(slots or {})}
+        self._pools = {
+            resource: concurrent.futures.ThreadPoolExecutor(
+                max_workers=slots[resource],
+                thread_name_prefix=f"stage-{resource}")
+            for resource in {stage.resource for stage in self._stages}}
+
+    def submit(self, job):
+        self._in_flight.acquire()
+        job.start_time = time.time()
+        self._schedule(job, 0)
+
+    def shutdown(self):
+        """Waits for all submitted jobs to finish."""
+        for _ in range(self._max_in_flight):
+            self._in_flight.acquire()
+        for pool in self._pools.values():
+            pool.shutdown()
+        for _ in range(self._max_in_flight):
+            self._in_flight.release()
+
+    def _schedule(self, job, index):
+        while (index < len(self._stages) and self._stages[index].when and
+               not self._stages[index].when(job)):
+            index += 1
+        if index == len(self._stages):
+            self._finish(job, None)
+            return
+        self._pools[self._stages[index].resource].submit(
+            self._run_stage, job, index)
+
+    def _run_stage(self, job, index):
+        stage = self._stages[index]
+        start = time.time()
+        thread_cpu_start = time.thread_time()
+        process_cpu_start = time.process_time()
+        try:
+            stage.fn(job)
+        except Exception as e:
+            logger.exception(f"{job.name}: {stage.name} failed")
+            self._finish(job, e)
+            return
+
+        # Thread CPU time misses torch's own worker threads while process
+        # CPU time includes other videos' overlapping stages. Keep both.
+        job.stage_metrics[stage.name] = {
+            'resource': stage.resource,
+            'wall_s': time.time() - start,
+            'thread_cpu_s': time.thread_time() - thread_cpu_start,
+            'process_cpu_s': time.process_time() - process_cpu_start,
+        }
+        logger.info(f"{job.name}: {stage.name} ({stage.resource}) took "
+                    f"{job.stage_metrics[stage.name]['wall_s']:.1f} seconds")
+        self._schedule(job, index + 1)
+
+    def _finish(self, job, error):
+        retry = None
+        try:
+            retry = self._on_done(job, error)
+        except Exception:
+            logger.exception(f"{job.name}: completion handler failed")
+        finally:
+            if retry is None:
+                self._in_flight.release()
+        if retry is not None:
+            retry.start_time = time.time()
+            self._schedule(retry, 0)
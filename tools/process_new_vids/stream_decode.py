@@ -0,0 +1,94 @@
+# Decodes audio to raw 16kHz float32 PCM while it downloads.
+#
+# Without this the worker writes the downloaded mp4 to disk and the decode
+# stage reads it back through whisperx.load_audio's ffmpeg. decode_stream()
+# instead pipes the stream's bytes into ffmpeg as they arrive, so decoding
+# overlaps the network transfer and the mp4 never touches the disk. The
+# output is headerless mono float32 at 16kHz, the format whisperx and
+# pyannote take in memory, so load() memory maps it instead of decoding.
+#
+# The map is the only copy of a video's audio. ASR, alignment, diarization
+# and the chunks of a long video all take views of it, its pages live in
+# the page cache rather than the worker's anonymous memory, and any other
+# process can map the same file without a copy. Audio that did not arrive
+# as PCM is decoded to a file with decode_file() first for the same reason.
+#
+# YouTube serves fragmented mp4 and webm audio which ffmpeg can demux from
+# a pipe. A container it cannot raises CalledProcessError and the caller
+# falls back to downloading the file first.
+
+import logging
+import subprocess
+import tempfile
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+DTYPE = numpy.float32
+BYTES_PER_SECOND = SAMPLE_RATE * numpy.dtype(DTYPE).itemsize
+
+# Extension of decoded audio. The decode stage memory maps these.
+SUFFIX = ".pcm"
+
+
+def _ffmpeg(source, dest):
+    return ["ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+            "-threads", "0", "-i", source,
+            "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), str(dest)]
+
+
+def decode_stream(chunks, dest):
+    """Decodes the container bytes yielded by `chunks` into `dest`."""
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(_ffmpeg("pipe:0", dest),
+                                   stdin=subprocess.PIPE, stderr=stderr)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg gave up. Its exit status and stderr say why.
+            pass
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                returncode, process.args, stderr=stderr.read().decode(
+                    errors="replace"))
+    return dest
+
+
+def decode_file(source, dest):
+    """Decodes the audio file at `source` into `dest`."""
+    subprocess.run(_ffmpeg(str(source), dest), check=True)
+    return dest
+
+
+def load(path):
+    """Returns a memory map of decoded audio at `path`.
+
+    The map is copy-on-write. torch warns about arrays that are not
+    writable, and no stage writes to its audio so no page is ever copied.
+    """
+    if path.stat().st_size == 0:
+        # numpy cannot map an empty file.
+        return numpy.zeros(0, dtype=DTYPE)
+    return numpy.memmap(path, dtype=DTYPE, mode="c")
+
+
+def write(path, pieces):
+    """Writes the float32 arrays in `pieces` to `path` and maps it."""
+    with open(path, "wb") as f:
+        for piece in pieces:
+            numpy.asarray(piece, dtype=DTYPE).tofile(f)
+    return load(path)
@@ -0,0 +1,121 @@
+import unittest
+
+import numpy
+
+import chunking
+
+RATE = 1000
+
+
+def noise(seconds, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return rng.uniform(-1, 1, int(seconds * RATE)).astype(numpy.float32)
+
+
+class TestPlanChunks(unittest.TestCase):
+    def assertTiles(self, chunks, n):
+        self.assertEqual(chunks[0][2], 0)
+        self.assertEqual(chunks[-1][3], n)
+        for (_, _, _, own_end), (_, _, own_start, _) in zip(chunks,
+                                                            chunks[1:]):
+            self.assertEqual(own_end, own_start)
+        for start, end, own_start, own_end in chunks:
+            self.assertLessEqual(start, own_start)
+            self.assertLess(own_start, own_end)
+            self.assertLessEqual(own_end, end)
+
+    def test_short_audio_is_left_whole(self):
+        audio = noise(80)
+        self.assertEqual(chunking.plan_chunks(audio, RATE, chunk_s=60),
+                         [(0, len(audio), 0, len(audio))])
+
+    def test_cuts_in_the_quiet(self):
+        audio = noise(300)
+        audio[95 * RATE:96 * RATE] = 0
+        chunks = chunking.plan_chunks(audio, RATE, chunk_s=100, overlap_s=10,
+                                      search_s=20)
+        self.assertTiles(chunks, len(audio))
+        self.assertTrue(95 * RATE <= chunks[0][3] < 96 * RATE)
+        self.assertEqual(chunks[0][1], chunks[0][3] + 5 * RATE)
+        self.assertEqual(chunks[1][0], chunks[0][3] - 5 * RATE)
+
+    def test_short_chunks_with_silence_near_the_start(self):
+        audio = noise(300)
+        audio[10 * RATE:11 * RATE] = 0
+        for chunk_s in (60, 20):
+            chunks = chunking.plan_chunks(audio, RATE, chunk_s=chunk_s)
+            self.assertTiles(chunks, len(audio))
+            for _, _, own_start, own_end in chunks[:-1]:
+                self.assertGreaterEqual(own_end - own_start,
+                                        chunk_s * RATE // 2)
+
+
+class TestReconcileSpeakers(unittest.TestCase):
+    def test_matches_by_embedding(self):
+        chunks = [
+            {'turns': [{'start': 0, 'end': 5, 'speaker': 'A'},
+                       {'start': 5, 'end': 9, 'speaker': 'B'}],
+             'embeddings': {'A': [1, 0, 0], 'B': [0, 1, 0]},
+             'overlap': (0, 0)},
+            {'turns': [{'start': 8, 'end': 12, 'speaker': 'A'},
+                       {'start': 12, 'end': 15, 'speaker': 'B'},
+                       {'start': 15, 'end': 18, 'speaker': 'C'}],
+             'embeddings': {'A': [0, 0.9, 0.1], 'B': [1, 0.1, 0],
+                            'C': [0, 0, 1]},
+             'overlap': (8, 10)},
+        ]
+        self.assertEqual(chunking.reconcile_speakers(chunks), [
+            {'A': 'SPEAKER_00', 'B': 'SPEAKER_01'},
+            {'A': 'SPEAKER_01', 'B': 'SPEAKER_00', 'C': 'SPEAKER_02'},
+        ])
+
+    def test_matches_by_talk_overlap_without_embeddings(self):
+        chunks = [
+            {'turns': [{'start': 0, 'end': 8, 'speaker': 'A'},
+                       {'start': 8, 'end': 10, 'speaker': 'B'}],
+             'embeddings': None, 'overlap': (0, 0)},
+            {'turns': [{'start': 7, 'end': 8, 'speaker': 'X'},
+                       {'start': 8, 'end': 12, 'speaker': 'Y'}],
+             'embeddings': None, 'overlap': (7, 10)},
+        ]
+        self.assertEqual(chunking.reconcile_speakers(chunks)[1],
+                         {'X': 'SPEAKER_00', 'Y': 'SPEAKER_01'})
+
+
+class TestStitch(unittest.TestCase):
+    def test_keeps_each_segment_once_on_the_full_timeline(self):
+        # Chunk 0 spans [0, 12) and owns [0, 10); chunk 1 spans [8, 20) and
+        # owns [10, 20).
+        chunks = [(0, 12 * RATE, 0, 10 * RATE),
+                  (8 * RATE, 20 * RATE, 10 * RATE, 20 * RATE)]
+        results = [
+            {'language': 'en', 'segments': [
+                {'start': 1, 'end': 3, 'speaker': 'A', 'text': 'one',
+                 'words': [{'start': 1, 'end': 3, 'speaker': 'A'}]},
+                {'start': 9, 'end': 11.5, 'speaker': 'B', 'text': 'two'},
+            ]},
+            {'language': 'en', 'segments': [
+                {'start': 1, 'end': 3.5, 'speaker': 'X', 'text': 'two'},
+                {'start': 5, 'end': 11, 'speaker': 'Y', 'text': 'three',
+                 'words': [{'start': 5, 'end': 11, 'speaker': 'Y'}]},
+            ]},
+        ]
+        maps = [{'A': 'SPEAKER_00', 'B': 'SPEAKER_01'},
+                {'X': 'SPEAKER_01', 'Y': 'SPEAKER_00'}]
+
+        stitched = chunking.stitch(results, chunks, maps, RATE)
+
+        self.assertEqual(
+            [(s['start'], s['end'], s['speaker'], s['text'])
+             for s in stitched['segments']],
+            [(1, 3, 'SPEAKER_00', 'one'),
+             (9, 11.5, 'SPEAKER_01', 'two'),
+             (13, 19, 'SPEAKER_00', 'three')])
+        self.assertEqual(stitched['word_segments'], [
+            {'start': 1, 'end': 3, 'speaker': 'SPEAKER_00'},
+            {'start': 13, 'end': 19, 'speaker': 'SPEAKER_00'}])
+        self.assertEqual(stitched['language'], 'en')
+
+
+if __name__ == '__main__':
+    unittest.main()
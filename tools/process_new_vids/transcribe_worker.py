@@ -1,17 +1,33 @@
 #!python
 
-from pytubefix import YouTube
-
 import argparse
+import functools
 import json
 import os
 import pathlib
-import random
-import requests
 import subprocess
 import logging
 import time
 
+from api_client import ApiClient
+from audio_cache import AudioCache
+import autotune
+from budget import CompletionClock, TimeBudget
+import chunking
+from checkpoint import CheckpointStore
+from metrics import MetricsRecorder, machine_info
+from prefetch import AudioPrefetcher, GB
+from ranged_download import RangedDownloader, progress_path
+import runtime_table
+from runtime_table import RuntimeTable
+from stages import (CPU, GPU, IO, PipelineJob, ReplicaPool, Stage,
+                    StageExecutor)
+import stream_decode
+import transcript_codec
+import trim
+from video_metadata import MetadataCache
+from video_queue import LeaseHeartbeat, QueueAcker, QueuePoller, lease_videos
+
 logger = logging.getLogger(__name__)
 
 WORKING_DIR = '/tmp/workspace/app/transcribe'
@@ -21,11 +37,6 @@ AUTH_PARAMS = {
 }
 
 
-def make_endpoint_url(endpoint):
-    api_url = os.environ['API_BASE_URL']
-    return f"https://{endpoint}-{api_url}"
-
-
 def init_app(args):
     # Ensure there's a working directory.
     args.workdir.mkdir(parents=True, exist_ok=True)
@@ -36,105 +47,523 @@ def init_app(args):
         logging.getLogger().setLevel(logging.INFO)
 
 
-def get_vid_list():
-    response = requests.get(make_endpoint_url("video-queue"),
-                            params=AUTH_PARAMS)
+def make_engine(args, device):
+    """Loads the in-process WhisperX engine or returns None for the CLI."""
+    if not args.engine:
+        return None
+
+    try:
+        from whisperx_engine import WhisperXEngine
+        return WhisperXEngine(
+            model=args.model,
+            compute_type=args.compute_type,
+            device=device,
+            threads=args.threads,
+            hf_token=args.hf_token,
+            batch_size=args.batch_size)
+    except Exception:
+        logger.exception("Unable to load WhisperX engine. Falling back to "
+                         "whisperx subprocess per video.")
+        return None
+
+
+def run_whisperx_cli(audio_path, args):
+    # whisperx picks the device itself unless one was asked for.
+    device = [f"--device={args.device}"] if args.device else []
+    subprocess.run([
+        "whisperx",
+        f"--model={args.model}",
+        f"--compute_type={args.compute_type}",
+        *device,
+        f"--batch_size={args.batch_size}",
+        "--language=en",
+        f"--thread={args.threads}",
+        f"--hf_token={args.hf_token}",
+        "--diarize",
+        "--output_format=json",
+        f"--output_dir={str(args.workdir)}",
+        "--",
+        str(audio_path)], check=True)
+
+
+def resolve_audio_stream(video_id, args, metadata_cache):
+    video = metadata_cache.get(video_id)
+    stream = video.stream
+    num_bytes = stream.filesize
+    if args.stream_decode or args.mmap_audio:
+        # Decoded audio is several times the size of the container, which
+        # is also on disk if decoding has to fall back to a file, and
+        # trimmed audio is a second decoded copy.
+        num_bytes += ((video.length or 0) * stream_decode.BYTES_PER_SECOND *
+                      (2 if args.trim else 1))
+    return video, stream, num_bytes
+
+
+def download_stream(stream, dest, downloader=None):
+    """Downloads `stream` to `dest` in parallel ranges, else with pytubefix."""
+    if downloader:
+        try:
+            downloader.download(stream.url, dest, stream.filesize)
+            return
+        except Exception as e:
+            logger.warning(f"Ranged download of {dest.name} failed. Falling "
+                           f"back to a single stream: {e}")
+
+    # pytubefix writes to its own file so the ranged partial download and
+    # its progress survive for a later attempt to resume.
+    fallback_path = dest.with_name(dest.name + ".pytube")
+    try:
+        stream.download(output_path=str(dest.parent),
+                        filename=fallback_path.name, max_retries=5)
+        os.replace(fallback_path, dest)
+    finally:
+        fallback_path.unlink(missing_ok=True)
+    progress_path(dest).unlink(missing_ok=True)
+
+
+def download_pcm(stream, dest, downloader=None):
+    """Downloads `stream` and decodes it to 16kHz float32 PCM at `dest`."""
+    container_path = dest.with_name(dest.name + ".download")
+    # Streamed bytes cannot be resumed. If an earlier attempt left part of
+    # the container on disk, finish that download instead.
+    if downloader and not progress_path(container_path).exists():
+        try:
+            stream_decode.decode_stream(
+                downloader.iter_bytes(stream.url, stream.filesize), dest)
+            return
+        except Exception as e:
+            logger.warning(f"Decoding {dest.name} while downloading failed. "
+                           f"Downloading it first: {e}")
+
+    # An unfinished container download is kept to be resumed.
+    download_stream(stream, container_path, downloader)
+    try:
+        stream_decode.decode_file(container_path, dest)
+    finally:
+        container_path.unlink(missing_ok=True)
+
+
+def download_audio(video_id, stream, args, audio_cache=None,
+                   downloader=None):
+    logger.info(f"Downloading audio for {video_id}")
+    if args.stream_decode:
+        download_fn = functools.partial(download_pcm, stream,
+                                        downloader=downloader)
+        # Keeps decoded audio from aliasing the container in the cache and
+        # gives the cached file the extension the engine looks for.
+        itag = f"{stream.itag}{stream_decode.SUFFIX}"
+        filename = f"{video_id}{stream_decode.SUFFIX}"
+    else:
+        download_fn = functools.partial(download_stream, stream,
+                                        downloader=downloader)
+        itag = stream.itag
+        filename = f"{video_id}.mp4"
+
+    if audio_cache:
+        return audio_cache.fetch(video_id, itag,
+                                 lambda dest: download_fn(dest=dest))
+
+    audio_path = args.workdir.joinpath(filename)
+    download_fn(dest=audio_path)
+    return audio_path
+
+
+def upload_transcript(client, acker, heartbeat, item, transcript_obj,
+                      compress=True, compact=True):
+    video = item.video
+    metadata = {
+        'title': video.title,
+        'video_id': video.video_id,
+        'channel_id': video.channel_id,
+        'description': video.description,
+        'publish_date': video.publish_date,
+    }
+
+    logger.info(f"Uploading transcript for {item.video_id}")
+    body = {
+        'category': item.category,
+        'metadata': metadata,
+        'video_id': item.video_id
+    }
+    if compact:
+        body['compact_transcripts'] = {
+            transcript_obj["language"]: transcript_codec.encode(
+                transcript_obj)}
+    else:
+        body['transcripts'] = {transcript_obj["language"]: transcript_obj}
+    start = time.time()
+    if compress:
+        response, stats = client.put_gzip_json("transcript", body)
+        logger.info(
+            f"Uploaded {item.video_id} in {time.time() - start:.1f} seconds. "
+            f"{stats['raw_bytes']} bytes of json sent as "
+            f"{stats['compressed_bytes']} gzip bytes, saving "
+            f"{stats['raw_bytes'] - stats['compressed_bytes']} bytes")
+    else:
+        response = client.put("transcript", body)
+        logger.info(f"Uploaded {item.video_id} in "
+                    f"{time.time() - start:.1f} seconds")
 
     if response.status_code != 200:
-        raise Exception(response.text)
-    return response.json()['data']
+        raise Exception(f"Unable to upload transcript: {response.text}")
+
+    acker.ack(item.category, item.video_id)
+    heartbeat.done(item.category, item.video_id)
+
+
+def checkpointed(name, compute):
+    """Wraps compute(job) into a stage fn that saves its result.
+
+    The stage is skipped if a previous attempt already saved a result. The
+    result is left in job.state[name] for the next stage. Use
+    stage_result() to read it so it is reloaded from the checkpoint after a
+    resume.
+    """
+    def fn(job):
+        checkpoint = job.state['checkpoint']
+        if checkpoint.has(name):
+            logger.info(f"{job.name}: {name} already done. Skipping.")
+            job.state.setdefault('resumed_stages', []).append(name)
+            return
+        job.state[name] = compute(job)
+        checkpoint.save(name, job.state[name])
+    return fn
+
+
+def scratch_path(job, args, kind):
+    """Returns a path for job's temporary `kind` PCM, deleted when done."""
+    path = args.workdir.joinpath(
+        f"{job.item.video_id}.{kind}{stream_decode.SUFFIX}")
+    job.state.setdefault('scratch_paths', []).append(path)
+    return path
+
+
+def stage_result(job, name):
+    if name in job.state:
+        return job.state.pop(name)
+    return job.state['checkpoint'].load(name)
+
+
+def make_checkpoint_config(engine, args):
+    """Settings that change stage results. Checkpoints must match them."""
+    return {
+        'engine': engine is not None,
+        'model': args.model,
+        'compute_type': args.compute_type,
+        'batch_size': args.batch_size,
+        'language': 'en',
+        'trim': args.trim and [args.trim_min_silence_s,
+                               args.trim_threshold_db],
+        'chunk': args.chunk and [args.chunk_s, args.chunk_overlap_s],
+    }
+
+
+def make_stages(client, acker, heartbeat, engines, args):
+    """Returns the per-video pipeline, each stage tagged with its resource.
+
+    Expensive stages are checkpointed so a retry resumes at the first
+    stage that did not finish. Model stages borrow whichever of the
+    `engines` replicas is free, and long videos are split into chunks run
+    across all of them when there is more than one.
+    """
+    def transcript_path(job):
+        return args.workdir.joinpath(f"{job.item.video_id}.json")
+
+    def make_upload(transcript_stage):
+        def upload(job):
+            item = job.item
+            if heartbeat.is_lost(item.category, item.video_id):
+                # Another worker may be transcribing it now. Let it upload.
+                logger.warning(f"Lost the lease on {job.name}. Not "
+                               "uploading it.")
+                job.state['lease_lost'] = True
+                heartbeat.done(item.category, item.video_id)
+            else:
+                upload_transcript(client, acker, heartbeat, item,
+                                  stage_result(job, transcript_stage),
+                                  compress=args.compress_upload,
+                                  compact=args.compact_upload)
+            # Nothing reads the local copies once the server has it.
+            transcript_path(job).unlink(missing_ok=True)
+            job.state['checkpoint'].clear()
+        return upload
+
+    if not engines:
+        # The whisperx CLI runs every model in one process so it cannot be
+        # split up.
+        def whisperx_cli(job):
+            run_whisperx_cli(job.item.audio_path, args)
+            with open(transcript_path(job)) as f:
+                return json.load(f)
+
+        return [
+            Stage("whisperx", GPU, checkpointed("whisperx", whisperx_cli)),
+            Stage("upload", IO, make_upload("whisperx")),
+        ]
+
+    # Model replicas for ASR and alignment, and separately for diarization,
+    # which runs in the CPU pool alongside the GPU stages. Loading audio and
+    # assigning speakers need no model so use any engine.
+    gpu_pool = ReplicaPool(engines)
+    diarize_pool = ReplicaPool(engines)
+    engine = engines[0]
+
+    def decode(job):
+        # Only asr, align and diarize read the audio.
+        checkpoint = job.state['checkpoint']
+        if checkpoint.has('assign_speakers') or (
+                checkpoint.has('align') and checkpoint.has('diarize')):
+            return
+
+        # Every stage takes views of one memory map of the decoded audio
+        # rather than holding copies of it.
+        audio_path = job.item.audio_path
+        if args.mmap_audio and audio_path.suffix != stream_decode.SUFFIX:
+            audio_path = stream_decode.decode_file(
+                audio_path, scratch_path(job, args, "decoded"))
+        audio = engine.load_audio(audio_path)
+        audio_s = len(audio) / engine.sample_rate
+        job.state['audio_s'] = audio_s
+        if args.trim:
+            spans = trim.find_speech_spans(
+                audio, engine.sample_rate,
+                min_silence_s=args.trim_min_silence_s,
+                threshold_db=args.trim_threshold_db)
+            audio = trim.cut(audio, spans, args.mmap_audio and
+                             scratch_path(job, args, "trimmed"))
+            # Needed to remap the transcript even if a resume skips decode.
+            checkpoint.save('trim', trim.OffsetMap.from_sample_spans(
+                spans, engine.sample_rate).spans_s)
+            job.state['trimmed_s'] = audio_s - len(audio) / engine.sample_rate
+            logger.info(f"{job.name}: trimmed {job.state['trimmed_s']:.0f} "
+                        f"of {audio_s:.0f} seconds of non-speech")
+        job.state['audio'] = audio
+
+        if args.chunk and len(engines) > 1:
+            chunks = chunking.plan_chunks(
+                audio, engine.sample_rate, chunk_s=args.chunk_s,
+                overlap_s=args.chunk_overlap_s)
+            if len(chunks) > 1:
+                job.state['chunks'] = chunks
+
+    def is_chunked(job):
+        return 'chunks' in job.state
 
+    def transcribe_chunks(job):
+        result = chunking.transcribe_chunked(
+            gpu_pool, diarize_pool, job.state.pop('audio'),
+            engine.sample_rate, job.state['chunks'],
+            job.state['checkpoint'], job.name)
+        return to_original_timeline(job, result)
 
-def process_vids(vid_list, args):
-    for category, video_id in vid_list:
+    def to_original_timeline(job, result):
+        if args.trim:
+            offsets = trim.OffsetMap(job.state['checkpoint'].load('trim'))
+            result = offsets.remap_transcript(result)
+        return result
+
+    def asr(job):
+        with gpu_pool.acquire() as replica:
+            return replica.asr(job.state['audio'])
+
+    def align(job):
+        with gpu_pool.acquire() as replica:
+            return replica.align(stage_result(job, 'asr'),
+                                 job.state['audio'])
+
+    def diarize(job):
+        with diarize_pool.acquire() as replica:
+            return replica.diarize(job.state.pop('audio'))
+
+    def assign_speakers(job):
+        job.state.pop('audio', None)
+        result = engine.assign_speakers(stage_result(job, 'diarize'),
+                                        stage_result(job, 'align'))
+        return to_original_timeline(job, result)
+
+    def is_whole(job):
+        # A resumed video with a saved result may have been chunked. Its
+        # per-model stages have nothing saved and no audio to run on.
+        return not (is_chunked(job) or
+                    job.state['checkpoint'].has('assign_speakers'))
+
+    return [
+        Stage("decode", IO, decode),
+        # Chunked videos go through every model in one stage and save
+        # their result under the same name as the whole video path.
+        Stage("chunks", GPU,
+              checkpointed("assign_speakers", transcribe_chunks),
+              when=is_chunked),
+        Stage("asr", GPU, checkpointed("asr", asr), when=is_whole),
+        Stage("align", GPU, checkpointed("align", align), when=is_whole),
+        Stage("diarize", CPU, checkpointed("diarize", diarize),
+              when=is_whole),
+        Stage("assign_speakers", CPU,
+              checkpointed("assign_speakers", assign_speakers),
+              when=is_whole),
+        Stage("upload", IO, make_upload("assign_speakers")),
+    ]
+
+
+def job_audio_s(job):
+    audio_s = job.state.get('audio_s')
+    if audio_s is None:
+        # Decoding was skipped or done by the whisperx CLI.
+        audio_s = getattr(job.item.video, 'length', None)
+    return audio_s
+
+
+def record_metrics(metrics, job, error, peaks):
+    item = job.item
+    audio_s = job_audio_s(job)
+
+    metrics.record(
+        category=item.category,
+        video_id=item.video_id,
+        ok=error is None,
+        error=None if error is None else repr(error),
+        download_bytes=item.download_bytes,
+        download_s=item.download_s,
+        audio_s=audio_s,
+        trimmed_s=job.state.get('trimmed_s'),
+        num_chunks=len(job.state.get('chunks', [])) or 1,
+        total_s=time.time() - job.start_time,
+        stages=job.stage_metrics,
+        resumed_stages=job.state.get('resumed_stages', []),
+        lease_lost=job.state.get('lease_lost', False),
+        **peaks)
+
+
+def process_vids(client, engines, audio_cache, metadata_cache, metrics,
+                 budget, runtime_stats, runtime_profile, args):
+    # Claim enough videos per lease call to keep the pipeline full.
+    lease_batch = args.lease_batch or args.prefetch + (
+        args.pipeline_depth or len(engines) + 1)
+    acker = QueueAcker(client, args.ack_interval).start()
+    heartbeat = LeaseHeartbeat(client, args.lease_renew_interval).start()
+
+    def lease(category, video_ids):
+        granted = lease_videos(client, category, video_ids)
+        heartbeat.add(category, granted)
+        return granted
+
+    def skip(category, video_id):
+        budget.finish(f"{category}/{video_id}")
+        # Let another worker pick it up right away.
+        heartbeat.release(category, [video_id])
+
+    # Keep pulling work until the queue stays empty for --idle_timeout.
+    poller = QueuePoller(client, args.idle_timeout, args.poll_interval,
+                         args.queue_window)
+
+    def next_batch(n):
+        # Ending here drains the pipeline and exits, which hands back every
+        # lease still held and lets the instance be destroyed early.
+        if not budget.can_take_more():
+            logger.info(f"{budget.remaining_s():.0f} seconds left is not "
+                        "enough for another video. Taking no more work.")
+            return None
+        return poller.next_batch(
+            n, min(args.idle_timeout, budget.remaining_s()))
+
+    downloader = (RangedDownloader(args.download_connections)
+                  if args.download_connections > 0 else None)
+
+    # Lease and download upcoming videos while the current one transcribes.
+    prefetcher = AudioPrefetcher(
+        next_batch,
+        lease_fn=lease,
+        lease_batch=lease_batch,
+        resolve_fn=lambda video_id: resolve_audio_stream(
+            video_id, args, metadata_cache),
+        download_fn=lambda video_id, stream: download_audio(
+            video_id, stream, args, audio_cache, downloader),
+        workdir=args.workdir,
+        lookahead=args.prefetch,
+        disk_budget_bytes=int(args.disk_budget_gb * GB),
+        disk_reserve_bytes=int(args.disk_reserve_gb * GB),
+        discard_fn=(audio_cache and
+                    (lambda item: audio_cache.unpin(item.audio_path))),
+        admit_fn=lambda category, video_id, duration_s: budget.admit(
+            f"{category}/{video_id}", duration_s),
+        on_skip_fn=skip
+    ).start()
+
+    clock = CompletionClock()
+
+    def on_done(job, error):
         try:
-            logger.info(f"Processing {category} {video_id}")
-
-            # Mark us as starting work on this video. Failure okay as
-            # transcription is semantically idempotent and this is just an
-            # advisory lease.
-            response = requests.patch(
-                make_endpoint_url("video-queue"),
-                json={**AUTH_PARAMS, 'category': category,
-                      'video_ids': [video_id]})
-
-            if response.status_code != 200:
-                logger.error(f"{response.status_code} {response.text}: "
-                             "Server did not allow start. Someone else might "
-                             "have gotten to it first. Skip.")
-                continue
-
-            logger.info(f"Leased {category} {video_id}. Downloading audio")
-
-            # Download the audio file.
-            outfile_name = f"{video_id}.mp4"
-            video = YouTube(f"https://www.youtube.com/watch?v={video_id}",
-                            "WEB")
-            audio_streams = video.streams.filter(
-                only_audio=True).order_by('abr')
-            audio_streams.first().download(
-                output_path=str(args.workdir),
-                filename=outfile_name,
-                max_retries=5,
-                skip_existing=args.cache)
-
-            # Run whisper for transcription
-            start = time.time()
-            logger.info(f"Starting Whisper at {start} on {outfile_name} "
-                        f"writing to {args.workdir}")
-            subprocess.run([
-                "whisperx",
-                f"--model={args.model}",
-                f"--compute_type={args.compute_type}",
-                "--language=en",
-                f"--thread={args.threads}",
-                f"--hf_token={args.hf_token}",
-                "--diarize",
-                "--output_format=json",
-                f"--output_dir={str(args.workdir)}",
-                "--",
-                str(args.workdir.joinpath(outfile_name))])
-            end = time.time()
-            logger.info("Whisper took: %d seconds" % (end - start))
-
-            # Upload json transcript.
-            metadata = {
-                'title': video.title,
-                'video_id': video.video_id,
-                'channel_id': video.channel_id,
-                'description': video.description,
-                'publish_date': video.publish_date.isoformat(),
-            }
-
-            with open(args.workdir.joinpath(f"{video_id}.json")) as f:
-                transcript_obj = json.load(f)
-
-            logger.info("Uploading transcript")
-            response = requests.put(
-                make_endpoint_url("transcript"),
-                json={
-                    **AUTH_PARAMS,
-                    'category': category,
-                    'transcripts': {transcript_obj["language"]:
-                                    transcript_obj},
-                    'metadata': metadata,
-                    'video_id': video_id
-                })
-
-            if response.status_code != 200:
-                logger.error("Unable to upload transcript", response.json())
-                continue
-
-            logger.info("Deleting video from queue")
-            response = requests.delete(
-                make_endpoint_url("video-queue"),
-                json={**AUTH_PARAMS, 'category': category,
-                      'video_ids': [video_id]})
-            if response.status_code != 200:
-                logger.error("Unable to delete queue item", response.json())
-                continue
+            record_metrics(metrics, job, error,
+                           metrics.sampler.stop(job.name))
         except Exception:
-            logger.exception("Transcribe failed for " + video_id)
+            logger.exception(f"Unable to record metrics for {job.name}")
+        for path in job.state.get('scratch_paths', []):
+            path.unlink(missing_ok=True)
+
+        checkpoint = job.state['checkpoint']
+        attempt = job.state.get('attempt', 1)
+        if (error is not None and attempt <= args.max_retries and
+                budget.predict_s(job.item.video.length) <
+                budget.remaining_s()):
+            # Retry here while we still hold the lease and the audio, so it
+            # resumes from its checkpoints instead of starting over on
+            # another machine.
+            logger.warning(f"Retrying {job.name} ({attempt} of "
+                           f"{args.max_retries}) with checkpoints for "
+                           f"{', '.join(checkpoint.stages()) or 'nothing'}")
+            retry = PipelineJob(job.name, job.item)
+            retry.state.update(checkpoint=checkpoint, attempt=attempt + 1)
+            metrics.sampler.start(retry.name)
+            return retry
+
+        prefetcher.release(job.item)
+        if error is None:
+            elapsed_s = time.time() - job.start_time
+            # Failed attempts are charged to the next video that finishes.
+            charged_s = clock.charge(job.start_time)
+            logger.info(f"Finished {job.name} in {elapsed_s:.1f} seconds, "
+                        f"{charged_s:.1f} of them pipeline time")
+            # Resumed videos skipped stages so their time would mislead.
+            if job.state.get('resumed_stages'):
+                budget.finish(job.name)
+            else:
+                budget.finish(job.name, job.item.video.length, charged_s)
+                if job_audio_s(job):
+                    runtime_stats.add(runtime_profile, job_audio_s(job),
+                                      charged_s, job.stage_metrics)
+        else:
+            budget.finish(job.name)
+            logger.error(f"Transcribe failed for {job.name}")
+            # Another worker starts over without our checkpoints.
+            checkpoint.clear()
+            # Let another worker retry it right away.
+            heartbeat.release(job.item.category, [job.item.video_id])
+        return None
+
+    checkpoints = CheckpointStore(args.workdir.joinpath("checkpoints"))
+    checkpoint_config = make_checkpoint_config(
+        engines[0] if engines else None, args)
+
+    # Overlap the stages of consecutive videos that use different resources,
+    # with one GPU stage and one diarization in flight per engine replica.
+    executor = StageExecutor(
+        make_stages(client, acker, heartbeat, engines, args), on_done,
+        slots={GPU: max(1, len(engines)), CPU: max(1, len(engines))},
+        max_in_flight=args.pipeline_depth or len(engines) + 1)
+    try:
+        for item in prefetcher:
+            job = PipelineJob(f"{item.category}/{item.video_id}", item)
+            job.state['checkpoint'] = checkpoints.open(
+                item.video_id, checkpoint_config)
+            metrics.sampler.start(job.name)
+            executor.submit(job)
+    finally:
+        poller.close()
+        executor.shutdown()
+        prefetcher.close()
+        acker.close()
+        # Hands back leases on videos that were claimed but never finished.
+        heartbeat.close()
 
 
 def main():
@@ -162,26 +591,249 @@ def main():
                         default="large-v3-turbo")
     parser.add_argument('--compute_type', dest='compute_type',
                         metavar="COMPUTE_TYPE", type=str,
-                        help='The compute type to use', default="float32")
-    parser.add_argument('-s', '--shuffle', dest='shuffle',
-                        help='Shuffle video list as poorman race reduction',
+                        help=('The compute type to use. Defaults to the '
+                              'fastest one the GPU supports'))
+    parser.add_argument('--device', dest='device', metavar="DEVICE",
+                        type=str,
+                        help=('Torch device to run models on without a GPU. '
+                              'Defaults to cpu'))
+    parser.add_argument('--devices', dest='devices', metavar="DEVICE",
+                        type=str, nargs='+',
+                        help=('Devices to load a model replica on. Defaults '
+                              'to every visible GPU'))
+    parser.add_argument('--replicas_per_device', dest='replicas_per_device',
+                        metavar="NUM_REPLICAS", type=int, default=1,
+                        help=('Model replicas per device. Each holds its own '
+                              'copy of every model'))
+    parser.add_argument('--batch_size', dest='batch_size',
+                        metavar="BATCH_SIZE", type=int,
+                        help=('ASR inference batch size. Defaults to the '
+                              'largest that fits in free GPU memory'))
+    parser.add_argument('--calibrate', dest='calibrate',
+                        help=('Check the batch size with an ASR run on '
+                              'prime_model.mp4 at startup, halving it while '
+                              'it runs out of GPU memory'),
+                        default=False,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--engine', dest='engine',
+                        help=('Keep WhisperX models loaded in-process across '
+                              'videos. --no-engine runs the whisperx CLI per '
+                              'video'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--trim', dest='trim',
+                        help=('Cut long non-speech spans from the audio '
+                              'before transcribing. Transcript times still '
+                              'match the original video'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--trim_min_silence_s', dest='trim_min_silence_s',
+                        metavar="SECONDS", type=float, default=30,
+                        help='Shortest non-speech span that is cut')
+    parser.add_argument('--trim_threshold_db', dest='trim_threshold_db',
+                        metavar="DB", type=float, default=30,
+                        help=('How far below the speech level audio must be '
+                              'to count as non-speech'))
+    parser.add_argument('--chunk', dest='chunk',
+                        help=('Split long videos into chunks transcribed in '
+                              'parallel when there is more than one model '
+                              'replica'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--chunk_s', dest='chunk_s', metavar="SECONDS",
+                        type=float, default=30 * 60,
+                        help='Target chunk length. Cuts are made at silence')
+    parser.add_argument('--chunk_overlap_s', dest='chunk_overlap_s',
+                        metavar="SECONDS", type=float, default=30,
+                        help='Audio shared by neighbouring chunks')
+    parser.add_argument('--pipeline_depth', dest='pipeline_depth',
+                        metavar="NUM_VIDEOS", type=int, default=None,
+                        help=('Number of videos whose stages may overlap, '
+                              'e.g. one in ASR while another diarizes. '
+                              'Defaults to one more than the replicas'))
+    parser.add_argument('--lease_batch', dest='lease_batch',
+                        metavar="NUM_VIDEOS", type=int, default=None,
+                        help=('Videos to claim per lease call. Defaults to '
+                              'PREFETCH + PIPELINE_DEPTH'))
+    parser.add_argument('--ack_interval', dest='ack_interval',
+                        metavar="SECONDS", type=float, default=60,
+                        help='How often finished videos are removed from '
+                             'the queue')
+    parser.add_argument('--lease_renew_interval',
+                        dest='lease_renew_interval', metavar="SECONDS",
+                        type=float, default=30 * 60,
+                        help='How often held leases are renewed')
+    parser.add_argument('--compress_upload', dest='compress_upload',
+                        help='Stream the transcript upload gzip compressed',
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--compact_upload', dest='compact_upload',
+                        help=('Upload the compact columnar transcript '
+                              'encoding instead of raw whisperx json'),
+                        default=True,
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('--metrics_file', dest='metrics_file',
+                        metavar="JSONL_FILE", type=pathlib.Path,
+                        help=('Per-video metrics are appended here. Defaults '
+                              'to WORK_DIR/metrics.jsonl'))
+    parser.add_argument('--time_budget', dest='time_budget',
+                        metavar="MINUTES", type=float, default=None,
+                        help=('Minutes until lysine_protocol.sh stops the '
+                              'instance. Videos that cannot finish by then '
+                              'are left for other workers'))
+    parser.add_argument('--deadline', dest='deadline',
+                        metavar="UNIX_SECONDS", type=float, default=None,
+                        help=('When lysine_protocol.sh stops the instance. '
+                              'Overrides --time_budget, which starts '
+                              'counting late if startup is slow'))
+    parser.add_argument('--expected_rtf', dest='expected_rtf',
+                        metavar="RATIO", type=float, default=None,
+                        help=('Initial guess of processing seconds per '
+                              'second of audio. Refined as videos finish. '
+                              'Defaults to the runtime learned for this '
+                              'machine profile, else 0.3'))
+    parser.add_argument('--download_connections',
+                        dest='download_connections',
+                        metavar="NUM_CONNECTIONS", type=int, default=4,
+                        help=('Parallel byte range requests per audio '
+                              'download. 0 downloads with pytubefix over a '
+                              'single connection'))
+    parser.add_argument('--stream_decode', dest='stream_decode',
+                        help=('Decode audio to 16kHz PCM with ffmpeg as it '
+                              'downloads instead of saving the mp4 and '
+                              'decoding it in the decode stage. Needs '
+                              '--engine'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--mmap_audio', dest='mmap_audio',
+                        help=('Decode audio to a PCM file on disk that every '
+                              'stage memory maps, instead of holding it in '
+                              'memory'),
+                        default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--prefetch', dest='prefetch', metavar="NUM_VIDEOS",
+                        type=int, default=2,
+                        help='Number of videos to lease and download ahead')
+    # Matches DISK_GB in functions-python/main.py.
+    parser.add_argument('--disk_budget_gb', dest='disk_budget_gb',
+                        metavar="GB", type=float, default=25,
+                        help='Max disk held by downloaded audio')
+    parser.add_argument('--disk_reserve_gb', dest='disk_reserve_gb',
+                        metavar="GB", type=float, default=5,
+                        help=('Free disk that prefetching must leave for the '
+                              'running transcription'))
+    parser.add_argument('--idle_timeout', dest='idle_timeout',
+                        metavar="SECONDS", type=float, default=10 * 60,
+                        help='Exit once the queue has had no work for this '
+                             'long')
+    parser.add_argument('--poll_interval', dest='poll_interval',
+                        metavar="SECONDS", type=float, default=60,
+                        help='How often an empty queue is checked again')
+    parser.add_argument('--max_retries', dest='max_retries',
+                        metavar="NUM_RETRIES", type=int, default=2,
+                        help=('Times a failed video is retried from its '
+                              'checkpoints before another worker gets it'))
+    parser.add_argument('--queue_window', dest='queue_window',
+                        metavar="VIDEOS", type=int, default=100,
+                        help=('Each batch is picked at random from this many '
+                              'of the oldest unleased videos'))
     parser.add_argument('-c', '--cache', dest='cache',
-                        help='Do not redownload files if they are there',
+                        help=('Keep downloaded audio in an LRU cache under '
+                              'WORK_DIR instead of deleting it'),
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('--cache_gb', dest='cache_gb', metavar="GB",
+                        type=float, default=10,
+                        help='Byte budget of the --cache audio cache')
 
     args = parser.parse_args()
+    # The lysine clock started with the instance, before models load.
+    budget = TimeBudget(
+        None if args.time_budget is None else args.time_budget * 60,
+        rtf=args.expected_rtf or 0.3, deadline=args.deadline)
     init_app(args)
-    vid_list = [(category_tuple[0], vid) for category_tuple
-                in get_vid_list().items() for vid in category_tuple[1]]
+    client = ApiClient(os.environ['API_BASE_URL'], AUTH_PARAMS)
+
+    audio_cache = None
+    if args.cache:
+        audio_cache = AudioCache(args.workdir.joinpath("audio_cache"),
+                                 int(args.cache_gb * GB))
+
+    # With no GPU visible, run on --device, else the CPU.
+    args.devices = (args.devices or autotune.cuda_devices() or
+                    [args.device or "cpu"])
+    tuning = autotune.tune(args)
+    engine = make_engine(args, args.devices[0])
+    if engine and args.calibrate:
+        try:
+            tuning['calibration'] = autotune.calibrate(engine)
+            args.batch_size = engine.batch_size
+        except Exception:
+            logger.exception("Calibration failed. Keeping batch size "
+                             f"{engine.batch_size}")
+
+    # Replicas are loaded after calibration so they share its batch size.
+    engines = [engine] if engine else []
+    if engine:
+        devices = args.devices * args.replicas_per_device
+        for device in devices[1:]:
+            replica = make_engine(args, device)
+            if replica:
+                engines.append(replica)
+        logger.info(f"Loaded {len(engines)} model replicas on "
+                    f"{', '.join(sorted(set(devices)))}")
+
+    if args.stream_decode and not engines:
+        # The whisperx CLI cannot read headerless PCM.
+        args.stream_decode = False
+
+    machine = machine_info(args)
+    metrics = MetricsRecorder(
+        args.metrics_file or args.workdir.joinpath("metrics.jsonl"),
+        {**machine, 'autotune': tuning})
+
+    # YouTube metadata of every video, kept across retries and restarts.
+    metadata_cache = MetadataCache(args.workdir.joinpath("metadata_cache"))
+
+    # Rows not yet added to the shared runtime table, from a run that could
+    # not upload them.
+    pending_path = args.workdir.joinpath("runtime_table.json")
+    runtime_stats = RuntimeTable.load(pending_path)
+    runtime_profile = runtime_table.profile_key(
+        machine.get('gpu_model'), args.compute_type, args.threads,
+        machine.get('gpu_count'))
+    if args.expected_rtf is None:
+        try:
+            learned = RuntimeTable(runtime_table.fetch_rows(client))
+        except Exception:
+            logger.exception("Unable to fetch the runtime table")
+            learned = RuntimeTable()
+        learned.merge(runtime_stats.rows)
+        estimate = learned.coefficients(runtime_profile)
+        if estimate:
+            logger.info(f"Learned runtime for {runtime_profile}: "
+                        f"{estimate[0]:.0f} seconds plus {estimate[1]:.3f} "
+                        "per second of audio")
+            budget.set_estimate(*estimate)
+
+    process_vids(client, engines, audio_cache, metadata_cache, metrics,
+                 budget, runtime_stats, runtime_profile, args)
+
+    metrics.close()
+
+    if runtime_stats.rows:
+        try:
+            runtime_table.upload_rows(client, runtime_stats.rows)
+            pending_path.unlink(missing_ok=True)
+        except Exception:
+            logger.exception("Unable to add to the runtime table. Keeping "
+                             f"the rows in {pending_path}")
+            runtime_stats.save(pending_path)
 
-    # Poorman race reduction between workers.
-    if args.shuffle:
-        random.shuffle(vid_list)
-    logger.info(f"Found {len(vid_list)} videos")
-    logger.debug(vid_list)
+    client.log_stats()
 
-    process_vids(vid_list, args)
+    metadata_cache.log_stats()
+    if audio_cache:
+        audio_cache.log_stats()
 
 
 if __name__ == "__main__":
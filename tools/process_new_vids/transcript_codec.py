@@ -0,0 +1,225 @@
+#!python
+# Compact columnar encoding of WhisperX transcripts.
+#
+# As common/whisperx.ts notes, the WhisperX json is over 10x larger than the
+# words it carries. Every word is an object repeating its key names, the
+# speaker string is repeated on every word and segment, and timestamps and
+# scores are floats. The compact form stores parallel arrays instead:
+# words, millisecond integer starts and ends, per-mille integer scores and
+# indices into a speaker table. Segment text is only stored when it is not
+# just the segment's words joined by spaces.
+#
+# WhisperX already rounds times and scores to 3 decimals, so decode(encode(x))
+# gives back the same {segments, language} json. The decoder is mirrored by
+# decodeCompactWhisperX() in common/whisperx.ts for the transcript endpoint.
+#
+# Run this file directly to benchmark size and speed on whisperx json files.
+
+import argparse
+import gzip
+import json
+import lzma
+import pathlib
+import time
+
+FORMAT = "whisperx-columnar"
+VERSION = 1
+
+# Real meeting transcript shipped as testdata. Despite the .xz extension it
+# is plain json.
+DEFAULT_BENCHMARK_FILE = pathlib.Path(__file__).parents[2].joinpath(
+    "testdata/testbucket/transcripts/public/testcategory/archive/whisperx/"
+    "a95KMDHf4vQ.en.json.xz")
+
+
+def _to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000)
+
+
+def _from_ms(ms):
+    return None if ms is None else ms / 1000
+
+
+def encode(transcript):
+    """Returns the compact columnar form of a whisperx transcript dict."""
+    speakers = []
+    speaker_index = {}
+
+    def speaker_id(speaker):
+        if speaker is None:
+            return None
+        if speaker not in speaker_index:
+            speaker_index[speaker] = len(speakers)
+            speakers.append(speaker)
+        return speaker_index[speaker]
+
+    segment_starts = []
+    segment_ends = []
+    segment_speakers = []
+    segment_word_counts = []
+    segment_text_prefixes = []
+    segment_texts = {}
+    words = []
+    word_starts = []
+    word_ends = []
+    word_scores = []
+    word_speakers = []
+
+    for i, segment in enumerate(transcript["segments"]):
+        segment_words = segment.get("words", [])
+        segment_starts.append(_to_ms(segment.get("start")))
+        segment_ends.append(_to_ms(segment.get("end")))
+        segment_speakers.append(speaker_id(segment.get("speaker")))
+        segment_word_counts.append(len(segment_words))
+
+        text = segment.get("text", "")
+        prefix = text[:len(text) - len(text.lstrip())]
+        segment_text_prefixes.append(prefix)
+        if text != prefix + " ".join(w["word"] for w in segment_words):
+            segment_texts[str(i)] = text
+
+        for word in segment_words:
+            words.append(word["word"])
+            word_starts.append(_to_ms(word.get("start")))
+            word_ends.append(_to_ms(word.get("end")))
+            score = word.get("score")
+            word_scores.append(None if score is None else round(score * 1000))
+            word_speakers.append(speaker_id(word.get("speaker")))
+
+    return {
+        "format": FORMAT,
+        "version": VERSION,
+        "language": transcript["language"],
+        "speakers": speakers,
+        "segment_starts": segment_starts,
+        "segment_ends": segment_ends,
+        "segment_speakers": segment_speakers,
+        "segment_word_counts": segment_word_counts,
+        "segment_text_prefixes": segment_text_prefixes,
+        "segment_texts": segment_texts,
+        "words": words,
+        "word_starts": word_starts,
+        "word_ends": word_ends,
+        "word_scores": word_scores,
+        "word_speakers": word_speakers,
+    }
+
+
+def decode(compact):
+    """Returns the whisperx {segments, language} dict for `compact`."""
+    if compact.get("format") != FORMAT or compact.get("version") != VERSION:
+        raise ValueError(f"Unsupported transcript encoding "
+                         f"{compact.get('format')} v{compact.get('version')}")
+
+    speakers = compact["speakers"]
+    words = compact["words"]
+    word_starts = compact["word_starts"]
+    word_ends = compact["word_ends"]
+    word_scores = compact["word_scores"]
+    word_speakers = compact["word_speakers"]
+    segment_texts = compact["segment_texts"]
+
+    segments = []
+    w = 0
+    for i, num_words in enumerate(compact["segment_word_counts"]):
+        segment_words = []
+        for j in range(w, w + num_words):
+            word = {"word": words[j]}
+            if word_starts[j] is not None:
+                word["start"] = _from_ms(word_starts[j])
+            if word_ends[j] is not None:
+                word["end"] = _from_ms(word_ends[j])
+            if word_scores[j] is not None:
+                word["score"] = word_scores[j] / 1000
+            if word_speakers[j] is not None:
+                word["speaker"] = speakers[word_speakers[j]]
+            segment_words.append(word)
+        w += num_words
+
+        segment = {}
+        if compact["segment_starts"][i] is not None:
+            segment["start"] = _from_ms(compact["segment_starts"][i])
+        if compact["segment_ends"][i] is not None:
+            segment["end"] = _from_ms(compact["segment_ends"][i])
+        if str(i) in segment_texts:
+            segment["text"] = segment_texts[str(i)]
+        else:
+            segment["text"] = (compact["segment_text_prefixes"][i] +
+                               " ".join(words[w - num_words:w]))
+        segment["words"] = segment_words
+        if compact["segment_speakers"][i] is not None:
+            segment["speaker"] = speakers[compact["segment_speakers"][i]]
+        segments.append(segment)
+
+    return {"segments": segments, "language": compact["language"]}
+
+
+def _strip_to_upload_form(transcript):
+    # Only {segments, language} is uploaded. word_segments is a flattened
+    # copy of the words which the server never reads.
+    return {"segments": transcript["segments"],
+            "language": transcript["language"]}
+
+
+def _time_best_of(fn, arg, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def benchmark(path, repeat=5):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"\xfd7zXZ"):
+        data = lzma.decompress(data)
+    transcript = _strip_to_upload_form(json.loads(data))
+
+    compact, encode_s = _time_best_of(encode, transcript, repeat)
+    decoded, decode_s = _time_best_of(decode, compact, repeat)
+
+    raw = json.dumps(transcript, ensure_ascii=False).encode()
+    packed = json.dumps(compact, ensure_ascii=False,
+                        separators=(",", ":")).encode()
+    num_words = len(compact["words"])
+    result = {
+        "file": str(path),
+        "words": num_words,
+        "round_trip_ok": decoded == transcript,
+        "encode_ms": encode_s * 1000,
+        "decode_ms": decode_s * 1000,
+        "encode_words_per_s": num_words / encode_s if encode_s else None,
+        "decode_words_per_s": num_words / decode_s if decode_s else None,
+        "bytes": {
+            "whisperx_json": len(raw),
+            "whisperx_json_gzip": len(gzip.compress(raw)),
+            "whisperx_json_xz": len(lzma.compress(raw)),
+            "compact_json": len(packed),
+            "compact_json_gzip": len(gzip.compress(packed)),
+            "compact_json_xz": len(lzma.compress(packed)),
+        },
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Compact transcript codec benchmark.',
+        description=('Measures size and encode/decode speed of the compact '
+                     'columnar encoding on whisperx json files'))
+    parser.add_argument('files', metavar="WHISPERX_JSON", nargs='*',
+                        type=pathlib.Path,
+                        default=[DEFAULT_BENCHMARK_FILE],
+                        help='whisperx json files, optionally xz compressed')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='Timing runs per file. The best is reported')
+    args = parser.parse_args()
+
+    for path in args.files:
+        print(json.dumps(benchmark(path, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
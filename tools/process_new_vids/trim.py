@@ -0,0 +1,136 @@
+# Cuts long non-speech spans out of audio before transcription.
+#
+# Board and council recordings carry long recesses, closed sessions and dead
+# air before the meeting starts, all of which ASR and diarization would
+# otherwise grind through. find_speech_spans() marks frames far quieter than
+# the recording's speech level and drops runs of them longer than
+# `min_silence_s`, keeping some padding so word edges are never clipped.
+# The detector is deliberately conservative: a recess with music or chatter
+# is kept.
+#
+# Citations link to a time in the YouTube video so the transcript must stay
+# on the original timeline. OffsetMap maps times in the trimmed audio back
+# and remap_transcript() applies it to every segment and word.
+
+import bisect
+import logging
+
+import numpy
+
+import stream_decode
+
+logger = logging.getLogger(__name__)
+
+# Frames are scored in blocks to bound the memory of squaring hours of
+# audio.
+_BLOCK_FRAMES = 60 * 20
+
+
+def find_speech_spans(audio, sample_rate, min_silence_s=30, threshold_db=30,
+                      floor_db=-60, pad_s=1, frame_s=0.05):
+    """Returns [start, end] sample ranges of `audio` to keep.
+
+    A frame is silent when it is `threshold_db` below the loud speech level
+    (95th percentile frame) or under `floor_db` dBFS. Audio that is silent
+    throughout is kept whole since the models cannot take empty audio.
+    """
+    frame_len = int(frame_s * sample_rate)
+    num_frames = len(audio) // frame_len
+    if num_frames == 0:
+        return [[0, len(audio)]]
+
+    db = numpy.empty(num_frames, dtype=numpy.float32)
+    for start in range(0, num_frames, _BLOCK_FRAMES):
+        end = min(start + _BLOCK_FRAMES, num_frames)
+        frames = audio[start * frame_len:end * frame_len].reshape(
+            end - start, frame_len)
+        db[start:end] = 10 * numpy.log10(
+            numpy.mean(numpy.square(frames, dtype=numpy.float32), axis=1) +
+            1e-10)
+
+    level = numpy.percentile(db, 95)
+    silent = (db < level - threshold_db) | (db < floor_db)
+
+    # Runs of silent frames as [start, end) frame indices.
+    edges = numpy.diff(numpy.concatenate(
+        ([0], silent.astype(numpy.int8), [0])))
+    run_starts = numpy.flatnonzero(edges == 1)
+    run_ends = numpy.flatnonzero(edges == -1)
+
+    min_frames = int(min_silence_s / frame_s)
+    pad_frames = int(pad_s / frame_s)
+    spans = []
+    kept_from = 0
+    for run_start, run_end in zip(run_starts, run_ends):
+        if run_end - run_start < min_frames:
+            continue
+        cut_from = (run_start + pad_frames) * frame_len
+        cut_to = (run_end - pad_frames) * frame_len
+        if run_start == 0:
+            cut_from = 0
+        if run_end == num_frames:
+            # Trailing silence, including the partial last frame.
+            cut_to = len(audio)
+        if cut_to <= cut_from:
+            continue
+        if cut_from > kept_from:
+            spans.append([kept_from, int(cut_from)])
+        kept_from = int(cut_to)
+    if kept_from < len(audio):
+        spans.append([kept_from, len(audio)])
+    return spans or [[0, len(audio)]]
+
+
+def cut(audio, spans, path=None):
+    """Returns `audio` with only the sample ranges in `spans`.
+
+    With a `path` the result is written there and memory mapped rather
+    than held in memory.
+    """
+    if len(spans) == 1 and spans[0] == [0, len(audio)]:
+        return audio
+    pieces = [audio[start:end] for start, end in spans]
+    if path:
+        return stream_decode.write(path, pieces)
+    return numpy.concatenate(pieces)
+
+
+class OffsetMap:
+    """Maps times in trimmed audio back to the original timeline."""
+
+    def __init__(self, spans_s):
+        # [original_start_s, original_end_s] of each kept span.
+        self.spans_s = spans_s
+        self._trimmed_starts = []
+        trimmed = 0
+        for start, end in spans_s:
+            self._trimmed_starts.append(trimmed)
+            trimmed += end - start
+
+    @classmethod
+    def from_sample_spans(cls, spans, sample_rate):
+        return cls([[start / sample_rate, end / sample_rate]
+                    for start, end in spans])
+
+    def to_original(self, t):
+        if t is None or not self.spans_s:
+            return t
+        i = max(0, bisect.bisect_right(self._trimmed_starts, t) - 1)
+        return round(self.spans_s[i][0] + t - self._trimmed_starts[i], 3)
+
+    def remap_transcript(self, result):
+        """Moves whisperx segment and word times onto the original timeline.
+
+        Modifies and returns `result`.
+        """
+        words = [word for segment in result.get("segments", [])
+                 for word in segment.get("words", [])]
+        # whisperx's word_segments can share dicts with the segments' words.
+        items = {id(item): item for item in (
+            result.get("segments", []) + words +
+            result.get("word_segments", []))}
+        for item in items.values():
+            for key in ("start", "end"):
+                if key in item:
+                    item[key] = self.to_original(item[key])
+        return result
@@ -0,0 +1,135 @@
+# YouTube metadata resolved once per video.
+#
+# pytubefix's YouTube object fetches the watch page and player response
+# lazily, property by property, so reading the title for the upload hours
+# after the stream was picked could go back to YouTube, and a retried video
+# resolved everything again. resolve() reads every field the worker uses,
+# along with the audio stream it will download and the duration, in one
+# place and MetadataCache keeps the result as a small json file per video.
+# Scheduling, the download and the upload all use that record.
+#
+# Stream urls are signed and expire after a few hours, so a cached record
+# is only reused while its url is still valid. The metadata itself never
+# changes and is written again along with a fresh url.
+
+import dataclasses
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+from pytubefix import YouTube
+
+logger = logging.getLogger(__name__)
+
+# A cached stream url must stay valid this long to be reused, which covers
+# the prefetch lookahead and a slow download.
+_MIN_URL_LIFE_S = 60 * 60
+# For urls without an expire parameter.
+_DEFAULT_URL_LIFE_S = 5 * 60 * 60
+
+
+def fetch_youtube(video_id):
+    return YouTube(f"https://www.youtube.com/watch?v={video_id}", "WEB")
+
+
+@dataclasses.dataclass
+class AudioStream:
+    video_id: str
+    itag: int
+    url: str
+    filesize: int
+    expires_at: float
+
+    def download(self, output_path, filename, max_retries=5):
+        """Downloads with pytubefix, resolving the stream again."""
+        stream = fetch_youtube(self.video_id).streams.get_by_itag(self.itag)
+        stream.download(output_path=output_path, filename=filename,
+                        max_retries=max_retries)
+
+
+@dataclasses.dataclass
+class VideoMetadata:
+    video_id: str
+    title: str
+    channel_id: str
+    description: str
+    # ISO 8601, as sent with the transcript.
+    publish_date: str
+    # Seconds, or None if YouTube did not say.
+    length: int
+    stream: AudioStream
+    fetched_at: float
+
+    def to_json(self):
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(**{**obj, 'stream': AudioStream(**obj['stream'])})
+
+
+def _url_expiry(url, now):
+    expire = urllib.parse.parse_qs(
+        urllib.parse.urlparse(url).query).get('expire')
+    try:
+        return float(expire[0])
+    except (TypeError, ValueError):
+        return now + _DEFAULT_URL_LIFE_S
+
+
+def resolve(video_id):
+    """Fetches the metadata and lowest bitrate audio stream of a video."""
+    now = time.time()
+    video = fetch_youtube(video_id)
+    stream = video.streams.filter(only_audio=True).order_by('abr').first()
+    return VideoMetadata(
+        video_id=video.video_id,
+        title=video.title,
+        channel_id=video.channel_id,
+        description=video.description,
+        publish_date=(video.publish_date and
+                      video.publish_date.isoformat()),
+        length=video.length,
+        stream=AudioStream(video_id=video.video_id, itag=stream.itag,
+                           url=stream.url,
+                           filesize=stream.filesize,
+                           expires_at=_url_expiry(stream.url, now)),
+        fetched_at=now)
+
+
+class MetadataCache:
+    """Keeps resolved VideoMetadata as json files under `cache_dir`."""
+
+    def __init__(self, cache_dir):
+        self._dir = cache_dir
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, video_id):
+        """Returns the video's metadata, resolving it if not cached."""
+        path = self._dir.joinpath(f"{video_id}.json")
+        try:
+            with open(path) as f:
+                metadata = VideoMetadata.from_json(json.load(f))
+            if metadata.stream.expires_at - time.time() > _MIN_URL_LIFE_S:
+                self.hits += 1
+                return metadata
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, KeyError):
+            logger.warning(f"Ignoring unreadable metadata for {video_id}")
+
+        self.misses += 1
+        metadata = resolve(video_id)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(metadata.to_json(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return metadata
+
+    def log_stats(self):
+        logger.info(f"Metadata cache: {self.hits} hits, {self.misses} "
+                    "misses")
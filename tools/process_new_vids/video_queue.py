@@ -0,0 +1,279 @@
+# Worker side of the video-queue endpoint (functions/src/video_queue.ts).
+#
+# Leases and acknowledgements are batched since PATCH and DELETE both take
+# a list of video_ids. Every request is an RTDB write on the server so one
+# call per batch instead of one per video matters with many workers.
+
+import collections
+import datetime
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_queue(client):
+    """Returns {category: {video_id: entry}} for every queued video."""
+    response = client.get("video-queue")
+
+    if response.status_code != 200:
+        raise Exception(response.text)
+    return response.json()['data']
+
+
+def is_leased(entry, now):
+    lease_expires = entry.get('lease_expires') if isinstance(
+        entry, dict) else None
+    if not lease_expires:
+        return False
+    return datetime.datetime.fromisoformat(lease_expires) > now
+
+
+class QueuePoller:
+    """Hands out unleased videos from the queue as the worker needs them.
+
+    Every call to next_batch() reads the queue fresh so videos enqueued
+    after startup are picked up, and videos someone else already leased are
+    never attempted. When the queue has nothing for us, next_batch() polls
+    every `poll_interval_s` and gives up with None after `idle_timeout_s`.
+
+    Each batch is a random sample of the `window` oldest videos rather than
+    the oldest ones. Every worker reads the same queue, so taking the head
+    of it would have them all try to lease the same videos at once.
+    """
+
+    def __init__(self, client, idle_timeout_s=10 * 60, poll_interval_s=60,
+                 window=100):
+        self._client = client
+        self._idle_timeout_s = idle_timeout_s
+        self._poll_interval_s = poll_interval_s
+        self._window = window
+        # Seeded from the OS so every worker draws a different sample.
+        self._random = random.Random()
+        self._attempted = set()
+        self._stop = threading.Event()
+
+    def unleased_videos(self):
+        now = datetime.datetime.now(datetime.UTC)
+        candidates = []
+        for category, entries in get_queue(self._client).items():
+            if not isinstance(entries, dict):
+                entries = {video_id: {} for video_id in entries}
+            for video_id, entry in entries.items():
+                if is_leased(entry, now):
+                    continue
+                added = entry.get('add', '') if isinstance(entry, dict) else ''
+                candidates.append((added, category, video_id))
+        return [(category, video_id) for _, category, video_id
+                in sorted(candidates)]
+
+    def next_batch(self, n, idle_timeout_s=None):
+        """Returns up to `n` videos, or None once idle for too long.
+
+        `idle_timeout_s` overrides the poller's idle timeout for this call.
+        """
+        if idle_timeout_s is None:
+            idle_timeout_s = self._idle_timeout_s
+        deadline = time.time() + idle_timeout_s
+        while not self._stop.is_set():
+            try:
+                # Skip videos this worker already tried. If they failed here
+                # they are better off on another machine.
+                candidates = [vid for vid in self.unleased_videos()
+                              if vid not in self._attempted]
+                candidates = candidates[:max(n, self._window)]
+                batch = self._random.sample(candidates,
+                                            min(n, len(candidates)))
+            except Exception:
+                logger.exception("Unable to read video queue")
+                batch = []
+
+            if batch:
+                self._attempted.update(batch)
+                return batch
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.info("Video queue idle. No more work.")
+                return None
+            logger.debug("Video queue empty. Waiting.")
+            self._stop.wait(min(self._poll_interval_s, remaining))
+        return None
+
+    def close(self):
+        self._stop.set()
+
+
+def lease_videos(client, category, video_ids):
+    """Leases `video_ids` in `category` and returns the ids granted."""
+    # Failure okay as transcription is semantically idempotent and this is
+    # just an advisory lease. Re-leasing our own lease just renews it so the
+    # call is safe to retry.
+    response = client.patch(
+        "video-queue", {'category': category, 'video_ids': list(video_ids)},
+        idempotent=True)
+
+    if response.status_code != 200:
+        logger.error(f"{response.status_code} {response.text}: "
+                     "Server did not allow start. Someone else might "
+                     "have gotten to it first. Skip.")
+        return []
+
+    granted = response.json()['data'].get('updated_ids', [])
+    logger.info(f"Leased {category} {', '.join(granted)}")
+    return granted
+
+
+def release_leases(client, category, video_ids):
+    """Gives up our leases so other workers can pick the videos up now."""
+    response = client.patch(
+        "video-queue",
+        {'category': category, 'video_ids': list(video_ids), 'release': True},
+        idempotent=True)
+    if response.status_code != 200:
+        logger.error(f"Unable to release {category} {video_ids}: "
+                     f"{response.text}")
+        return
+    logger.info(f"Released {category} {', '.join(video_ids)}")
+
+
+class LeaseHeartbeat:
+    """Keeps renewing the leases on every video this worker holds.
+
+    The server grants 2 hour leases, which a long meeting can outlive.
+    Leases are added as they are granted and dropped with done() once the
+    video is finished, or handed back with release() if it failed. close()
+    releases whatever is still held. A lease that fails to renew is dropped
+    and is_lost() reports it, since another worker may own the video now.
+    """
+
+    def __init__(self, client, interval_s=30 * 60):
+        self._client = client
+        self._interval_s = interval_s
+        self._lock = threading.Lock()
+        self._held = collections.defaultdict(set)
+        self._lost = collections.defaultdict(set)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="lease-heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, category, video_ids):
+        with self._lock:
+            self._held[category].update(video_ids)
+            self._lost[category].difference_update(video_ids)
+
+    def done(self, category, video_id):
+        with self._lock:
+            self._held[category].discard(video_id)
+            self._lost[category].discard(video_id)
+
+    def is_lost(self, category, video_id):
+        with self._lock:
+            return video_id in self._lost[category]
+
+    def release(self, category, video_ids):
+        with self._lock:
+            self._held[category].difference_update(video_ids)
+        try:
+            release_leases(self._client, category, video_ids)
+        except Exception:
+            logger.exception(f"Unable to release {category} {video_ids}")
+
+    def renew(self):
+        held = self._snapshot()
+
+        for category, video_ids in held.items():
+            try:
+                renewed = set(lease_videos(self._client, category, video_ids))
+            except Exception:
+                logger.exception(f"Unable to renew {category} {video_ids}")
+                continue
+
+            with self._lock:
+                # Videos finished since the snapshot are gone from the queue.
+                lost = (set(video_ids) - renewed) & self._held[category]
+                self._held[category] -= lost
+                self._lost[category] |= lost
+            if lost:
+                logger.warning(f"Lost leases on {category} "
+                               f"{', '.join(sorted(lost))}")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        held = self._snapshot()
+        for category, video_ids in held.items():
+            self.release(category, video_ids)
+
+    def _snapshot(self):
+        with self._lock:
+            return {category: sorted(video_ids)
+                    for category, video_ids in self._held.items()
+                    if video_ids}
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            self.renew()
+
+
+class QueueAcker:
+    """Removes finished videos from the queue in batched DELETEs.
+
+    Acks are flushed every `flush_interval_s` and on close(). A video whose
+    ack is lost to a crash stays in the queue and is transcribed again once
+    its lease expires, which is wasteful but not wrong.
+    """
+
+    def __init__(self, client, flush_interval_s=60):
+        self._client = client
+        self._flush_interval_s = flush_interval_s
+        self._lock = threading.Lock()
+        self._pending = collections.defaultdict(list)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="queue-acker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def ack(self, category, video_id):
+        with self._lock:
+            self._pending[category].append(video_id)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = (self._pending,
+                                      collections.defaultdict(list))
+
+        for category, video_ids in pending.items():
+            logger.info(f"Deleting {category} {', '.join(video_ids)} from "
+                        "queue")
+            try:
+                response = self._client.delete(
+                    "video-queue",
+                    {'category': category, 'video_ids': video_ids})
+                if response.status_code == 200:
+                    continue
+                logger.error(f"Unable to delete queue items: {response.text}")
+            except Exception:
+                logger.exception("Unable to delete queue items")
+
+            # Try again on the next flush.
+            with self._lock:
+                self._pending[category].extend(video_ids)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval_s):
+            self.flush()
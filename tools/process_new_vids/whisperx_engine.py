@@ -0,0 +1,121 @@
+# In-process WhisperX pipeline.
+#
+# The whisperx CLI reloads torch, the ASR weights, the alignment model and
+# the pyannote diarization pipeline on every invocation. That costs minutes
+# of GPU time per video. WhisperXEngine loads each model once and reuses it
+# for every video the worker processes.
+
+import logging
+
+import stream_decode
+
+logger = logging.getLogger(__name__)
+
+
+class WhisperXEngine:
+    def __init__(self, model, compute_type, device, threads, hf_token,
+                 batch_size=8, language="en", diarize=True):
+        # Imported lazily so the subprocess fallback still works on machines
+        # where whisperx cannot be imported into this interpreter.
+        import pandas
+        import torch
+        import whisperx
+        from whisperx.diarize import DiarizationPipeline
+
+        self._pandas = pandas
+        self._whisperx = whisperx
+        self.sample_rate = whisperx.audio.SAMPLE_RATE
+        self.device = device
+        self.batch_size = batch_size
+        self.language = language
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+        # ctranslate2 takes the GPU index separately from the device type
+        # while torch takes "cuda:1".
+        device_type, _, device_index = device.partition(":")
+        logger.info(f"Loading ASR model {model} ({compute_type}) on {device}")
+        self.asr_model = whisperx.load_model(
+            model, device_type, device_index=int(device_index or 0),
+            compute_type=compute_type, language=language, threads=threads)
+
+        logger.info(f"Loading alignment model for {language}")
+        self._align_models = {}
+        self._get_align_model(language)
+
+        # The pyannote models are gated behind a Hugging Face token, so
+        # benchmarks without one can skip diarization.
+        self.diarize_model = None
+        if diarize:
+            logger.info("Loading diarization pipeline")
+            self.diarize_model = DiarizationPipeline(
+                use_auth_token=hf_token, device=device)
+
+    def _get_align_model(self, language):
+        if language not in self._align_models:
+            self._align_models[language] = self._whisperx.load_align_model(
+                language_code=language, device=self.device)
+        return self._align_models[language]
+
+    # The stages below are exposed separately so StageExecutor can run the
+    # GPU bound stages of one video while another video diarizes on the CPU.
+
+    def load_audio(self, audio_path):
+        # Audio decoded while it downloaded is already in whisperx's format.
+        if audio_path.suffix == stream_decode.SUFFIX:
+            return stream_decode.load(audio_path)
+        return self._whisperx.load_audio(str(audio_path))
+
+    def asr(self, audio):
+        result = self.asr_model.transcribe(
+            audio, batch_size=self.batch_size, language=self.language)
+        result.setdefault("language", self.language)
+        return result
+
+    def align(self, asr_result, audio):
+        language = asr_result["language"]
+        align_model, align_metadata = self._get_align_model(language)
+        result = self._whisperx.align(
+            asr_result["segments"], align_model, align_metadata, audio,
+            self.device, return_char_alignments=False)
+        result["language"] = language
+        return result
+
+    def diarize(self, audio):
+        """Returns speaker turns as a list of {start, end, speaker} dicts.
+
+        Plain dicts, rather than pyannote's DataFrame, so the turns can be
+        checkpointed as json.
+        """
+        diarize_df = self.diarize_model(audio)
+        return [{'start': float(start), 'end': float(end), 'speaker': speaker}
+                for start, end, speaker in zip(diarize_df['start'],
+                                               diarize_df['end'],
+                                               diarize_df['speaker'])]
+
+    def diarize_with_embeddings(self, audio):
+        """Returns (speaker turns, {speaker: embedding vector} or None).
+
+        Older whisperx releases cannot return embeddings.
+        """
+        try:
+            diarize_df, embeddings = self.diarize_model(
+                audio, return_embeddings=True)
+        except TypeError:
+            return self.diarize(audio), None
+        turns = [{'start': float(start), 'end': float(end),
+                  'speaker': speaker}
+                 for start, end, speaker in zip(diarize_df['start'],
+                                                diarize_df['end'],
+                                                diarize_df['speaker'])]
+        return turns, {speaker: [float(x) for x in vector]
+                       for speaker, vector in (embeddings or {}).items()}
+
+    def assign_speakers(self, speaker_turns, aligned_result):
+        diarize_df = self._pandas.DataFrame(
+            speaker_turns, columns=['start', 'end', 'speaker'])
+        result = self._whisperx.assign_word_speakers(
+            diarize_df, aligned_result)
+        result["language"] = aligned_result["language"]
+        return result